@@ -0,0 +1,81 @@
+# fake_robot.py
+# Stand-in for the robot's control server, logs every frame it receives
+
+import argparse, socket, sys, threading, time
+
+FRAME_LEN = 5
+
+
+class FakeRobot(object):
+    def __init__(self, host='127.0.0.1', port=2001, log_file=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(4)
+        self.log_file = log_file
+        self.frames = []
+        self.lock = threading.Lock()
+        self.running = True
+
+    @property
+    def address(self):
+        return self.sock.getsockname()
+
+    def start(self):
+        threading.Thread(target=self.accept_loop, name='fake-robot', daemon=True).start()
+        return self
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.read_loop, args=(conn,), daemon=True).start()
+
+    def read_loop(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = b''
+        with conn:
+            while self.running:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                t = time.monotonic()
+                buf += data
+                while len(buf) >= FRAME_LEN:
+                    frame, buf = buf[:FRAME_LEN], buf[FRAME_LEN:]
+                    self.record(t, frame)
+
+    def record(self, t, frame):
+        with self.lock:
+            self.frames.append((t, frame))
+        if self.log_file is not None:
+            self.log_file.write('%.6f %s\n' % (t, frame.hex()))
+            self.log_file.flush()
+
+    def received(self):
+        with self.lock:
+            return list(self.frames)
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake robot control server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=2001)
+    args = parser.parse_args()
+    robot = FakeRobot(args.host, args.port, sys.stdout).start()
+    print("Listening on %s:%d" % robot.address)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        robot.stop()
+
+
+if __name__ == '__main__':
+    main()
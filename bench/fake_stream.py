@@ -0,0 +1,103 @@
+# fake_stream.py
+# Serves a recorded video as an mjpg-streamer style MJPEG stream
+
+import argparse, http.server, socketserver, threading, time
+import cv2
+import numpy as np
+
+BOUNDARY = b'boundarydonotcross'
+
+
+def synthetic_frames(size, count=60):
+    # moving box on a gradient, used when no video is given
+    w, h = size
+    base = np.tile(np.linspace(0, 255, w, dtype=np.uint8), (h, 1))
+    frames = []
+    for i in range(count):
+        img = cv2.cvtColor(base, cv2.COLOR_GRAY2BGR)
+        x = int((w - 80) * i / count)
+        cv2.rectangle(img, (x, h // 3), (x + 80, h // 3 + 80), (0, 0, 255), -1)
+        frames.append(img)
+    return frames
+
+
+def load_frames(path, size, quality=80, limit=600):
+    # frames are encoded up front so serving only costs socket writes
+    images = []
+    if path:
+        cap = cv2.VideoCapture(path)
+        while len(images) < limit:
+            ok, img = cap.read()
+            if not ok:
+                break
+            images.append(cv2.resize(img, size))
+        cap.release()
+    if not images:
+        images = synthetic_frames(size)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    return [cv2.imencode('.jpg', img, params)[1].tobytes() for img in images]
+
+
+class StreamServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_handler(frames, fps):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace;boundary=' + BOUNDARY.decode())
+            self.end_headers()
+            period = 1.0 / fps
+            next_t = time.monotonic()
+            i = 0
+            try:
+                while True:
+                    jpeg = frames[i % len(frames)]
+                    i += 1
+                    self.wfile.write(b'--' + BOUNDARY + b'\r\nContent-Type: image/jpeg\r\n' +
+                                     b'Content-Length: %d\r\n\r\n' % len(jpeg) + jpeg + b'\r\n')
+                    next_t += period
+                    time.sleep(max(0.0, next_t - time.monotonic()))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+def serve(frames, fps, host='127.0.0.1', port=8080):
+    # starts the server on a background thread, port 0 picks a free port
+    server = StreamServer((host, port), make_handler(frames, fps))
+    threading.Thread(target=server.serve_forever, name='fake-stream', daemon=True).start()
+    return server
+
+
+def parse_size(text):
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a video as an MJPEG stream')
+    parser.add_argument('video', nargs='?', help='video file, synthetic frames if omitted')
+    parser.add_argument('--fps', type=float, default=30.0)
+    parser.add_argument('--size', type=parse_size, default=(640, 480))
+    parser.add_argument('--quality', type=int, default=80)
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    frames = load_frames(args.video, args.size, args.quality)
+    server = serve(frames, args.fps, '0.0.0.0', args.port)
+    print("Serving %d frames at %.1f fps on http://localhost:%d/?action=stream" %
+          (len(frames), args.fps, server.server_address[1]))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# replay.py
+# Replays the commands of a session log against a robot, by default a
+# local fake robot, with the original timing
+#
+#   python3 bench/replay.py session.rlog --start 120 --speed 2
+
+import argparse, os, socket, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import fake_robot
+import sessionlog
+
+
+def describe(kind, value):
+    if kind == sessionlog.MARKER:
+        return 'marker %d %s' % (value[1], value[0])
+    if kind == sessionlog.FACE:
+        name, dist = value
+        return 'face %s' % name if dist is None else 'face %s (%.2f)' % (name, dist)
+    if kind == sessionlog.VIDEO:
+        return 'video %s at %.1f fps' % (value[0], value[2])
+    return 'cmd %s' % value.hex()
+
+
+def parse_address(text):
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a session log')
+    parser.add_argument('log', help='session log file')
+    parser.add_argument('--start', type=float, default=0.0, help='seconds into the session to start at')
+    parser.add_argument('--end', type=float, default=None, help='seconds into the session to stop at')
+    parser.add_argument('--speed', type=float, default=1.0, help='playback speed, 0 sends as fast as possible')
+    parser.add_argument('--robot', type=parse_address, default=None,
+                        help='host:port of the robot, a local fake robot is started if not given')
+    parser.add_argument('--quiet', action='store_true', help='do not print the records')
+    args = parser.parse_args()
+
+    reader = sessionlog.SessionReader(args.log)
+    videos = reader.videos()
+    robot = None
+    address = args.robot
+    if address is None:
+        robot = fake_robot.FakeRobot(port=0).start()
+        address = robot.address
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    sent = 0
+    t_wall = time.monotonic()
+    try:
+        for t, kind, payload in reader.records(args.start):
+            if args.end is not None and t > args.end:
+                break
+            if args.speed > 0:
+                delay = (t - args.start) / args.speed - (time.monotonic() - t_wall)
+                if delay > 0:
+                    time.sleep(delay)
+            value = sessionlog.decode(kind, payload)
+            if kind == sessionlog.CMD:
+                sock.sendall(value)
+                sent += 1
+            if not args.quiet:
+                at = sessionlog.video_frame(videos, t)
+                where = ' [%s #%d]' % at if at else ''
+                print('%9.3f %s%s' % (t, describe(kind, value), where))
+    except KeyboardInterrupt:
+        pass
+    sock.close()
+    reader.close()
+    if robot is not None:
+        # let the last frames arrive
+        time.sleep(0.2)
+        print("Fake robot received %d of %d commands" % (len(robot.received()), sent))
+        robot.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+# run_bench.py
+# Offline benchmark of the video pipeline and control path, runs against
+# a local fake stream and fake robot instead of the real robot
+#
+#   python3 bench/run_bench.py [video] --fps 30 --size 640x480 --seconds 10
+
+import argparse, json, os, shutil, socket, sys, tempfile, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+# the pipeline needs no display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import cv2
+import numpy as np
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QGuiApplication
+import fake_stream, fake_robot
+import metrics, transport
+import video_controller as vcon
+from robot_protocol import RobotProtocol
+
+SCENARIOS = {
+    'baseline': {},
+    'face': {'do_face_recog': True},
+    'aruco': {'do_aruco': True},
+    'record': {'should_record_video': True},
+    'all': {'do_face_recog': True, 'do_aruco': True, 'should_record_video': True},
+    # the same work with and without the shared memory frame bus
+    'vision': {'do_face_recog': True, 'do_aruco': True},
+    'vision-bus': {'do_face_recog': True, 'do_aruco': True, 'use_frame_bus': True},
+}
+
+
+def percentiles(values, ps=(0.5, 0.95, 0.99)):
+    data = sorted(values)
+    if not data:
+        return dict(('p%d_ms' % int(p * 100), 0.0) for p in ps)
+    return dict(('p%d_ms' % int(p * 100), round(1000.0 * data[min(int(p * len(data)), len(data) - 1)], 3))
+                for p in ps)
+
+
+def make_workdir():
+    # the pipeline expects these relative to the working directory
+    work = tempfile.mkdtemp(prefix='robo_bench_')
+    for d in ('Screenshots', 'Videos', 'Faces/Known', 'Faces/Unknown'):
+        os.makedirs(os.path.join(work, d))
+    open(os.path.join(work, 'Faces/Known/faces.txt'), 'w').close()
+    # rough pinhole calibration, good enough to time pose estimation
+    fs = cv2.FileStorage(os.path.join(work, 'robo_cam1.yaml'), cv2.FILE_STORAGE_WRITE)
+    fs.write('camera_matrix', np.array([[600, 0, 320], [0, 600, 240], [0, 0, 1]], dtype=np.float64))
+    fs.write('dist_coeeff', np.zeros((1, 5), dtype=np.float64))
+    fs.release()
+    return work
+
+
+def run_video(app, url, seconds, flags):
+    metrics.REGISTRY.reset()
+    th = vcon.VThread()
+    th.stream_url = url
+    for k, v in flags.items():
+        setattr(th, k, v)
+    # stand in for the GUI painting each frame
+    th.changePixmap.connect(lambda img: th.frame_shown())
+    th.start()
+    QTimer.singleShot(int(seconds * 1000), app.quit)
+    app.exec_()
+    stats = th.stage_stats() if th.stages else {}
+    th.stop()
+    th.wait()
+    snap = metrics.REGISTRY.snapshot()
+    return {'stages': stats, 'timings': snap['timings']}
+
+
+def match_sends(sends, received):
+    # pairs each received frame with the send it came from, sends and
+    # arrivals are matched in order per channel, a send passed over was
+    # replaced by a newer frame of its channel before it went out
+    channels = {}
+    for t, frame in sends:
+        key = frame[:3] if frame[:3] in transport.COALESCE else frame
+        channels.setdefault(key, []).append((t, frame))
+    pos = dict.fromkeys(channels, 0)
+    latency = []
+    skipped = unmatched = 0
+    for t_arrival, frame in received:
+        key = frame[:3] if frame[:3] in transport.COALESCE else frame
+        queue = channels.get(key, ())
+        i = pos.get(key, 0)
+        while i < len(queue) and queue[i][1] != frame:
+            i += 1
+        if i == len(queue):
+            unmatched += 1
+            continue
+        skipped += i - pos[key]
+        latency.append(t_arrival - queue[i][0])
+        pos[key] = i + 1
+    return latency, skipped, unmatched
+
+
+def run_control(address, robot, count, rate):
+    # sends a servo sweep and times each frame until the robot reads it
+    metrics.REGISTRY.reset()
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sender = transport.CommandSender(sock)
+    sender.start()
+    sends = []
+    start = len(robot.received())
+    for i in range(count):
+        value = i % (RobotProtocol.SERVO_MAX + 1)
+        frame = RobotProtocol.horz(value)
+        sends.append((time.monotonic(), frame))
+        sender.send(frame)
+        if i % 50 == 0:
+            sends.append((time.monotonic(), RobotProtocol.STOP))
+            sender.send(RobotProtocol.STOP)
+        time.sleep(1.0 / rate)
+    time.sleep(0.5)
+    sender.close()
+    sock.close()
+    received = robot.received()[start:]
+    latency, skipped, unmatched = match_sends(sends, received)
+    result = {'sent': len(sends), 'received': len(received),
+              # replaced before going out, by the bench's count and the sender's
+              'coalesced': skipped, 'sender_coalesced': sender.coalesced,
+              'unmatched': unmatched}
+    result.update(percentiles(latency))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the controller offline')
+    parser.add_argument('video', nargs='?', help='recorded video, synthetic frames if omitted')
+    parser.add_argument('--fps', type=float, default=30.0)
+    parser.add_argument('--size', type=fake_stream.parse_size, default=(640, 480))
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, may repeat, default all of them')
+    parser.add_argument('--commands', type=int, default=500, help='control frames to send')
+    parser.add_argument('--rate', type=float, default=200.0, help='control frames per second')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    frames = fake_stream.load_frames(args.video and os.path.abspath(args.video), args.size)
+    server = fake_stream.serve(frames, args.fps, port=0)
+    url = 'http://127.0.0.1:%d/?action=stream' % server.server_address[1]
+    robot = fake_robot.FakeRobot(port=0).start()
+
+    work = make_workdir()
+    os.chdir(work)
+    app = QGuiApplication(sys.argv[:1])
+    results = {'fps': args.fps, 'size': list(args.size), 'video': {}}
+    try:
+        for name in args.scenario or sorted(SCENARIOS):
+            res = run_video(app, url, args.seconds, SCENARIOS[name])
+            results['video'][name] = res
+            disp = res['stages'].get('display', {})
+            print("%-10s display %5.1f fps" % (name, disp.get('fps', 0.0)))
+            for stage, t in sorted(res['timings'].items()):
+                print("    %-16s p50 %8.2f  p95 %8.2f  p99 %8.2f ms" %
+                      (stage, t['p50_ms'], t['p95_ms'], t['p99_ms']))
+        results['control'] = run_control(robot.address, robot, args.commands, args.rate)
+        print("control    %s" % results['control'])
+    finally:
+        robot.stop()
+        server.shutdown()
+        os.chdir(HERE)
+        shutil.rmtree(work, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
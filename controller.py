@@ -5,22 +5,48 @@
 
 # Get video module
 import video_controller as vcon
+import metrics
+import recorder
+import robots
+import sessionlog
+import teleop
+from robot_protocol import RobotProtocol
 # PyQt
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 # misc modules
-import socket, threading, time, sys
+import argparse, math, os, time, sys, logging
+
+log = logging.getLogger(__name__)
+
+# WASD to the drive direction they hold
+DRIVE_KEYS = {
+    Qt.Key_W: teleop.FORWARD,
+    Qt.Key_S: teleop.BACKWARD,
+    Qt.Key_A: teleop.LEFT,
+    Qt.Key_D: teleop.RIGHT,
+}
 
 class Program(QWidget):
     default_horz = 116
     default_vert = 68
+    # Robot addresses
+    ctrl_address = ('192.168.1.1', 2001)
+    stream_url = 'http://192.168.1.1:8080/?action=stream'
+    # (name, control address, stream url) per robot, None for just the one above
+    robot_configs = None
+    # folder for session logs, None turns logging off
+    session_log_dir = None
 
     def __init__(self):
         super(Program, self).__init__()
-        # Robot connections
-        self.ctrl_con = None
+        # Robot connections, teleop goes to the selected robot
+        configs = self.robot_configs or [('robot', self.ctrl_address, self.stream_url, None)]
+        self.robots = [robots.RobotLink(name, addr, url, self, engine) for name, addr, url, engine in configs]
+        self.robot = self.robots[0]
         self.robo_vis = None
+        self.tiled = False
         # Buttons
         self.f = QPushButton(self)
         self.b = QPushButton(self)
@@ -35,14 +61,14 @@ class Program(QWidget):
         self.v_reset = QPushButton(self)
         self.s_reset = QPushButton(self)
         # Face Recognition
-        self.is_face_recog_on = False
-        self.is_ar_on = False
         self.face_button = QPushButton(self)
         self.face_save = QPushButton(self)
         self.face_recog_status = QLabel(self)
         self.ar_mode = QPushButton(self)
+        # Marker following
+        self.follow_id = QSpinBox(self)
+        self.follow_button = QPushButton(self)
         # Recording
-        self.is_recording_vid = False
         self.record_pic1 = QPushButton(self)
         self.record_pic2 = QPushButton(self)
         self.record_vid = QPushButton(self)
@@ -60,10 +86,20 @@ class Program(QWidget):
         self.v_slider = QSlider(Qt.Horizontal, self)
         # Indicator
         self.is_con = QLabel(self)
-        self.is_con_status = False
-        # Video Screen
-        self.screen = QLabel(self)
+        # Video Screen, one per robot
+        self.screens = [QLabel(self) for robot in self.robots]
+        self.screen = self.screens[0]
         self.frame = QFrame(self)
+        # Robot selection
+        self.robot_select = QComboBox(self)
+        self.tile_button = QPushButton(self)
+        # Metrics overlay, drawn over the video
+        self.stats_button = QPushButton(self)
+        self.stats_label = QLabel(self)
+        self.stats_timer = QTimer(self)
+        # Keyboard driving, the timer feeds the keepalive and the watchdog
+        self.teleop = teleop.Teleop(self.run_cmd)
+        self.teleop_timer = QTimer(self)
         # Continue init
         self.lcdSetup()
         self.sliderSetup()
@@ -90,8 +126,9 @@ class Program(QWidget):
         self.record_pic2.setText('Save Screenshot')
         self.record_vid.setText('Start Recording')
         self.ar_mode.setText('AR MODE OFF')
+        self.stats_button.setText('Stats')
         # Setup Window
-        self.setGeometry(700,200,940,550)
+        self.setGeometry(700,200,940,580)
         self.setWindowTitle("Robot Controller")
         # Place Buttons
         self.f.move(70,50); self.b.move(70,110)
@@ -100,6 +137,7 @@ class Program(QWidget):
         self.s1.move(170, 50); self.s2.move(120, 510)
         self.record_pic1.move(545, 10); self.record_pic2.move(700, 10)
         self.record_vid.move(815, 10)
+        self.stats_button.move(450, 10)
         # Face Recognition
         self.face_recog_status.setText("Status: OFF")
         self.face_button.setText('Toggle Face Recognition')
@@ -132,53 +170,114 @@ class Program(QWidget):
         self.frame.move(280,50)
         self.frame.resize(640,480)
         self.frame.setStyleSheet('background-color: rgba(0,0,0,100%)')
+        self.stats_label.move(285,55)
+        self.stats_label.resize(400,300)
+        self.stats_label.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        self.stats_label.setStyleSheet('color: white; background-color: rgba(0,0,0,50%); font-family: monospace')
+        self.stats_label.hide()
+        # Robot selection
+        for robot in self.robots:
+            self.robot_select.addItem(robot.name)
+        self.robot_select.move(280, 540)
+        self.tile_button.setText('Tile View')
+        self.tile_button.move(450, 540)
+        if len(self.robots) < 2:
+            self.robot_select.hide()
+            self.tile_button.hide()
+        # Marker following
+        self.follow_id.setRange(0, 1023)
+        self.follow_id.setPrefix('Marker ')
+        self.follow_id.move(640, 540)
+        self.follow_button.setText('Follow Marker')
+        self.follow_button.move(760, 540)
+        self.layoutScreens()
         # Connection status
         self.is_con.setText('Status: Disconnected')
+        self.is_con.resize(160, 20)
         self.is_con.move(280, 10)
         # Show
         self.show()
-        # Connect Video
-        self.initializeVideo()
-        # Connect Controller
-        self.initializeControl()
-
-    def initializeControl(self):
-        # create socket
-        self.ctrl_con = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.ctrl_con.settimeout(0.1)
-        # bind sock to port
-        robo_ctrl_add = ('192.168.1.1', 2001)
-        try:
-            self.ctrl_con.connect(robo_ctrl_add)
-            self.is_con.setText('Status: Connected')
-            self.is_con_status = True
-        except Exception as e:
-            print(e)
-            print("Could not connect to control socket")
-            self.is_con.setText('Status: Disconnected')
-            self.is_con_status = False
-
-    def initializeVideo(self):
-        self.th = vcon.VThread()
-        self.th.changePixmap.connect(self.setImage)
-        self.th.videoReady.connect(self.vReady)
-        self.th.start()
+        # Connect Video and Controller, reconnects are handled for us
+        for robot in self.robots:
+            robot.share_workers = len(self.robots) > 1
+            if self.session_log_dir:
+                path = os.path.join(self.session_log_dir, '%s_%s.rlog' % (robot.name, time.strftime('%Y%m%d_%H%M%S')))
+                robot.session_log = sessionlog.SessionLog(path)
+            robot.changePixmap.connect(self.setImage)
+            robot.videoReady.connect(self.vReady)
+            robot.stateChanged.connect(self.robotState)
+            robot.start()
+
+    @property
+    def th(self):
+        # video thread of the selected robot
+        return self.robot.th
+
+    def layoutScreens(self):
+        n = len(self.robots)
+        if self.tiled:
+            cols = int(math.ceil(math.sqrt(n)))
+            rows = int(math.ceil(n / cols))
+        else:
+            cols, rows = 1, 1
+        w, h = 640 // cols, 480 // rows
+        for i, (robot, screen) in enumerate(zip(self.robots, self.screens)):
+            selected = robot is self.robot
+            if self.tiled:
+                screen.setGeometry(280 + (i % cols) * w, 50 + (i // cols) * h, w, h)
+                screen.setStyleSheet('border: 2px solid red' if selected else '')
+            else:
+                screen.setGeometry(280, 50, 640, 480)
+                screen.setStyleSheet('')
+            visible = self.tiled or selected
+            screen.setVisible(visible)
+            robot.setDisplay((w, h), visible)
+        self.stats_label.raise_()
+
+    def selectRobot(self, index):
+        # do not leave the last robot driving
+        self.teleop.clear()
+        self.robot = self.robots[index]
+        # show the selected robot's modes
+        self.face_recog_status.setText("Status: ON" if self.robot.is_face_recog_on else "Status: OFF")
+        self.ar_mode.setText('AR MODE ON' if self.robot.is_ar_on else 'AR MODE OFF')
+        self.record_vid.setText('Stop Recording' if self.robot.is_recording_vid else 'Start Recording')
+        self.follow_button.setText('Stop Following' if self.robot.follower else 'Follow Marker')
+        self.is_con.setText(self.robot.supervisor.state or 'Status: Disconnected')
+        self.layoutScreens()
+
+    def toggleTiled(self):
+        self.tiled = not self.tiled
+        self.tile_button.setText('Single View' if self.tiled else 'Tile View')
+        self.layoutScreens()
+
+    def robotState(self, state):
+        if self.sender() is self.robot:
+            self.is_con.setText(state)
 
     def setImage(self, image):
-        self.screen.setPixmap(QPixmap.fromImage(image))
+        robot = self.sender()
+        self.screens[self.robots.index(robot)].setPixmap(QPixmap.fromImage(image))
+        # let the video thread send the next frame
+        robot.frame_shown()
 
     def vReady(self, sig):
-        self.frame.setStyleSheet('background-color: rgba(0,0,0,0%)')
+        if self.sender() is not self.robot:
+            return
+        if sig:
+            self.frame.setStyleSheet('background-color: rgba(0,0,0,0%)')
+        else:
+            self.frame.setStyleSheet('background-color: rgba(0,0,0,100%)')
 
     def connectButtons(self):
         self.f.pressed.connect(self.forward_p)
-        self.f.released.connect(self.dir_stop)
+        self.f.released.connect(self.forward_r)
         self.b.pressed.connect(self.back_p)
-        self.b.released.connect(self.dir_stop)
+        self.b.released.connect(self.back_r)
         self.l.pressed.connect(self.left_p)
-        self.l.released.connect(self.dir_stop)
+        self.l.released.connect(self.left_r)
         self.r.pressed.connect(self.right_p)
-        self.r.released.connect(self.dir_stop)
+        self.r.released.connect(self.right_r)
         self.con.clicked.connect(self.reconnect)
         self.s1.clicked.connect(self.dir_stop)
         self.s2.clicked.connect(self.dir_stop)
@@ -197,6 +296,13 @@ class Program(QWidget):
         self.record_pic2.released.connect(self.saveScreenshotStop2)
         self.record_vid.clicked.connect(self.toggleRecord)
         self.ar_mode.clicked.connect(self.toggleAR)
+        self.stats_button.clicked.connect(self.toggleStats)
+        self.follow_button.clicked.connect(self.toggleFollow)
+        self.stats_timer.timeout.connect(self.updateStats)
+        self.teleop_timer.timeout.connect(self.teleop.tick)
+        self.teleop_timer.start(50)
+        self.robot_select.currentIndexChanged.connect(self.selectRobot)
+        self.tile_button.clicked.connect(self.toggleTiled)
 
     def sliderSetup(self):
         self.h_slider.setMinimum(0)
@@ -228,40 +334,72 @@ class Program(QWidget):
         self.v_num.setMinimumWidth(40)
 
     def toggleFace(self):
-        if self.is_face_recog_on:
-            self.is_face_recog_on = False
+        if self.robot.is_face_recog_on:
+            self.robot.is_face_recog_on = False
             self.face_recog_status.setText("Status: OFF")
             self.th.do_face_recog = False
         else:
-            self.is_face_recog_on = True
+            self.robot.is_face_recog_on = True
             self.face_recog_status.setText("Status: ON")
             self.th.do_face_recog = True
             
     def toggleAR(self):
-        if self.is_ar_on:
-            self.is_ar_on = False
+        if self.robot.is_ar_on:
+            self.stopFollow()
+            self.robot.is_ar_on = False
             self.ar_mode.setText('AR MODE OFF')
             self.th.do_aruco = False
         else:
-            self.is_ar_on = True
+            self.robot.is_ar_on = True
             self.ar_mode.setText('AR MODE ON')
             self.th.do_aruco = True
 
+    def toggleFollow(self):
+        if self.robot.follower is not None:
+            self.stopFollow()
+        else:
+            log.info("Following marker %d", self.follow_id.value())
+            self.robot.follow(self.follow_id.value(), self.h_slider.value(), self.v_slider.value(),
+                              self.default_horz)
+            self.ar_mode.setText('AR MODE ON')
+            self.follow_button.setText('Stop Following')
+
+    def stopFollow(self):
+        # any STOP takes control back from the follower
+        if self.robot.follower is not None:
+            log.info("Stopped following")
+            self.robot.stopFollow()
+            self.follow_button.setText('Follow Marker')
+
+    def toggleStats(self):
+        if self.stats_label.isVisible():
+            self.stats_timer.stop()
+            self.stats_label.hide()
+        else:
+            self.updateStats()
+            self.stats_label.show()
+            self.stats_label.raise_()
+            self.stats_timer.start(500)
+
+    def updateStats(self):
+        # shared metrics plus the selected robot's
+        self.stats_label.setText(metrics.REGISTRY.overlay_text(robot=self.robot.name))
+
     def saveFaceOn(self):
-        print("save face!!")
+        log.info("Saving faces")
         self.th.save_face = True
 
     def saveFaceOff(self):
         self.th.save_face = False
 
     def toggleRecord(self):
-        if self.is_recording_vid:
+        if self.robot.is_recording_vid:
             self.record_vid.setText('Start Recording')
-            self.is_recording_vid = False
+            self.robot.is_recording_vid = False
             self.th.should_record_video = False
         else:
             self.record_vid.setText('Stop Recording')
-            self.is_recording_vid = True
+            self.robot.is_recording_vid = True
             self.th.should_record_video = True
 
 
@@ -280,116 +418,201 @@ class Program(QWidget):
     def keyPressEvent(self, e):
         if e.key() == Qt.Key_Escape:
             self.close()
+        # held keys repeat, only the first press counts
+        if e.isAutoRepeat():
+            return
         # WASD control
-        if e.key() == Qt.Key_W:
-            print("forward")
-            self.run_cmd( 'ff000100ff' )
-        elif e.key() == Qt.Key_S:
-            print("backward")
-            self.run_cmd( 'ff000200ff' )
-        elif e.key() == Qt.Key_A:
-            print("left")
-            self.run_cmd( 'ff000400ff' )
-        elif e.key() == Qt.Key_D:
-            print("right")
-            self.run_cmd( 'ff000300ff' )
+        if e.key() in DRIVE_KEYS:
+            log.debug("%s down", DRIVE_KEYS[e.key()])
+            self.stopFollow()
+            self.teleop.press( DRIVE_KEYS[e.key()] )
         elif e.key() == Qt.Key_Space:
-            print("STOP")
-            self.run_cmd( 'ff000000ff' )
-
+            log.debug("STOP")
+            self.stopFollow()
+            self.teleop.clear()
 
     def keyReleaseEvent(self, e):
+        if e.isAutoRepeat():
+            return
         # WASD Control
-        if e.key() == Qt.Key_W or e.key() == Qt.Key_S or\
-           e.key() == Qt.Key_A or e.key() == Qt.Key_D:
-            print("stop")
-            self.run_cmd( 'ff000000ff' )
+        if e.key() in DRIVE_KEYS:
+            log.debug("%s up", DRIVE_KEYS[e.key()])
+            self.teleop.release( DRIVE_KEYS[e.key()] )
+
+    def changeEvent(self, e):
+        # key releases are lost once the window is in the background
+        if e.type() == QEvent.ActivationChange and not self.isActiveWindow() and self.teleop.held:
+            log.debug("Window deactivated, stopping")
+            self.teleop.clear()
+        super(Program, self).changeEvent(e)
 
     def reconnect(self):
-        print("Reconnecting")
-        self.initializeVideo()
-        self.initializeControl()
+        log.info("Reconnecting %s", self.robot.name)
+        self.robot.restart()
+
+    def closeEvent(self, e):
+        self.teleop.clear()
+        self.teleop.close()
+        for robot in self.robots:
+            robot.shutdown()
+        e.accept()
+
+    # direction buttons hold a direction like the WASD keys, so the
+    # keepalive and the watchdog cover them too
+    def drive_p(self, direction):
+        log.debug("Button %s", direction)
+        self.stopFollow()
+        self.teleop.press( direction )
 
     def forward_p(self):
-        print("Forward")
-        self.run_cmd( 'ff000100ff' )
+        self.drive_p( teleop.FORWARD )
+
+    def forward_r(self):
+        self.teleop.release( teleop.FORWARD )
 
     def back_p(self):
-        print("Back")
-        self.run_cmd( 'ff000200ff' )
+        self.drive_p( teleop.BACKWARD )
+
+    def back_r(self):
+        self.teleop.release( teleop.BACKWARD )
 
     def left_p(self):
-        print("Left")
-        self.run_cmd( 'ff000400ff' )
+        self.drive_p( teleop.LEFT )
+
+    def left_r(self):
+        self.teleop.release( teleop.LEFT )
 
     def right_p(self):
-        print("Right")
-        self.run_cmd( 'ff000300ff' )
+        self.drive_p( teleop.RIGHT )
+
+    def right_r(self):
+        self.teleop.release( teleop.RIGHT )
 
     def dir_stop(self):
-        print("Button Stop")
-        self.run_cmd( 'ff000000ff' )
+        log.debug("Button Stop")
+        self.stopFollow()
+        self.teleop.clear()
 
     def text_send(self):
         textboxValue = self.textbox.text()
         self.textbox.setText('')
-        self.run_cmd( textboxValue )
+        try:
+            cmd = RobotProtocol.parse( textboxValue )
+        except ValueError as e:
+            log.warning("Bad command: %s", e)
+            return
+        self.run_cmd( cmd )
 
     def led_on(self):
-        print('LED on')
-        self.run_cmd( 'ff040000ff' )
+        log.debug('LED on')
+        self.run_cmd( RobotProtocol.LED_ON )
 
     def led_off(self):
-        print('LED off')
-        self.run_cmd( 'ff040100ff' )
+        log.debug('LED off')
+        self.run_cmd( RobotProtocol.LED_OFF )
 
     def set_speed(self, value):
         self.speed_num.display(value)
-        h = self.num_to_hex(value)
-        cmd_l = 'ff0201'+h+'ff'
-        cmd_r = 'ff0202'+h+'ff'
-        self.run_cmd( cmd_l )
-        self.run_cmd( cmd_r )
+        # curves are made from the motor speeds, so teleop sends them
+        self.teleop.set_speed(value)
 
     def set_horz(self, value):
         self.h_num.display(value)
-        h = self.num_to_hex(value)
-        cmd = 'ff0107'+h+'ff'
-        self.run_cmd( cmd )
+        self.run_cmd( RobotProtocol.horz(value) )
 
     def set_vert(self, value):
         self.v_num.display(value)
-        h = self.num_to_hex(value)
-        cmd = 'ff0108'+h+'ff'
-        self.run_cmd( cmd )
+        self.run_cmd( RobotProtocol.vert(value) )
 
     def reset_speed(self):
         self.speed.setValue(100)
         self.set_speed(100)
 
     def reset_horz(self):
-        print('Horz reset')
+        log.debug('Horz reset')
         self.h_slider.setValue(self.default_horz)
         self.set_horz(self.default_horz)
 
     def reset_vert(self):
-        print('Vert reset')
+        log.debug('Vert reset')
         self.v_slider.setValue(self.default_vert)
         self.set_vert(self.default_vert)
 
-    def num_to_hex(self, num):
-        if num < 10:
-            return '0'+format(num,'x')
-        else:
-            return format(num,'x')
-
-    def run_cmd(self, cmd_str):
-        if self.is_con_status:
-            byte_cmd = bytes.fromhex(cmd_str)
-            self.ctrl_con.sendall( byte_cmd )
+    def run_cmd(self, cmd):
+        # cmd is a frame from RobotProtocol, sent to the selected robot
+        self.robot.run_cmd( cmd )
+
+
+def vision_server_address(text):
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Robot controller')
+    parser.add_argument('--robot', action='append', help='robot host, repeat for several robots')
+    parser.add_argument('--ctrl-port', type=int, default=2001, help='control port')
+    parser.add_argument('--stream', default=None, help='video stream url')
+    parser.add_argument('--engine', action='append', default=[],
+                        help='host:port of a vision_server per robot, the engine runs in this process if not given')
+    parser.add_argument('--shot-format', choices=('jpg', 'png'), default='jpg', help='screenshot format')
+    parser.add_argument('--shot-quality', type=int, default=90, help='screenshot JPEG quality')
+    parser.add_argument('--shot-burst', type=float, default=0.0,
+                        help='screenshots per second while a button is held, 0 for one per press')
+    parser.add_argument('--record-codec', choices=sorted(recorder.Recorder.CODECS), default='mjpg',
+                        help='video codec, mjpg and xvid record to .avi, mp4v and h264 to .mp4')
+    parser.add_argument('--preroll', type=float, default=vcon.VThread.preroll_seconds,
+                        help='seconds of video kept from before recording starts, 0 for none')
+    parser.add_argument('--stream-control-url', metavar='URL', default=None,
+                        help='url asking the camera for a lower mode under load, '
+                             'with {host}, {width}, {height} and {fps}')
+    parser.add_argument('--frame-bus', action='store_true',
+                        help='run face detection and ArUco in parallel processes over shared memory')
+    parser.add_argument('--metrics-jsonl', metavar='FILE', default=None,
+                        help='append pipeline metrics to FILE as JSON lines every second')
+    parser.add_argument('--metrics-prom', metavar='FILE', default=None,
+                        help='write pipeline metrics to FILE in Prometheus text format every second')
+    parser.add_argument('--upstream-latency', type=float, default=0.0,
+                        help='camera and network delay in seconds added to the glass to glass latency')
+    parser.add_argument('--session-log', metavar='DIR', default=None,
+                        help='log commands, marker events and face matches of each robot to DIR')
+    parser.add_argument('--keepalive', type=float, default=teleop.Teleop.keepalive,
+                        help='seconds between repeats of the drive command while driving, 0 for none')
+    parser.add_argument('--watchdog', type=float, default=teleop.Teleop.watchdog,
+                        help='stop the robot when the GUI stalls for this many seconds, 0 for never')
+    parser.add_argument('--debug', action='store_true', help='verbose logging')
+    args, rest = parser.parse_known_args(argv[1:])
+    if not args.robot:
+        args.robot = ['192.168.1.1']
+    if args.stream is not None and len(args.robot) > 1:
+        parser.error('--stream only works with a single robot')
+    if len(args.engine) > len(args.robot):
+        parser.error('more --engine than --robot')
+    args.engine = [vision_server_address(e) for e in args.engine]
+    args.engine += [None] * (len(args.robot) - len(args.engine))
+    return args, argv[:1] + rest
 
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
+    args, qt_argv = parse_args(sys.argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    Program.robot_configs = [
+        (host, (host, args.ctrl_port), args.stream or 'http://%s:8080/?action=stream' % host, engine)
+        for host, engine in zip(args.robot, args.engine)]
+    vcon.VThread.screenshot_format = args.shot_format
+    vcon.VThread.screenshot_quality = args.shot_quality
+    vcon.VThread.screenshot_burst = args.shot_burst
+    vcon.VThread.use_frame_bus = args.frame_bus
+    vcon.VThread.stream_control_url = args.stream_control_url
+    vcon.VThread.record_codec = args.record_codec
+    vcon.VThread.preroll_seconds = args.preroll
+    vcon.VThread.metrics_jsonl = args.metrics_jsonl
+    vcon.VThread.metrics_prom = args.metrics_prom
+    vcon.VThread.upstream_latency = args.upstream_latency
+    Program.session_log_dir = args.session_log
+    teleop.Teleop.keepalive = args.keepalive
+    teleop.Teleop.watchdog = args.watchdog
+    app = QApplication(qt_argv)
     e = Program()
     sys.exit(app.exec_())
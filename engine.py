@@ -0,0 +1,556 @@
+# engine.py
+# Vision engine, reads the stream and runs the computer vision pipeline
+# without any GUI, the Qt video thread and the headless server build on it
+
+import cv2
+import numpy as np
+import datetime, threading, time, logging
+import pipeline
+import recorder
+import mjpeg
+import metrics
+import quality
+import screenshots
+import framebus
+
+log = logging.getLogger(__name__)
+
+# face_recognition (dlib) and ArUco are slow to import, these modules are
+# loaded the first time face or AR mode is turned on
+faces = None
+markers = None
+
+
+class VisionEngine(object):
+    do_face_recog = False
+    do_aruco = False
+    save_face = False
+    should_save_screenshot1 = False
+    should_save_screenshot2 = False
+    should_record_video = False
+    record_codec = 'mjpg'
+    record_fps = 20.0
+    # seconds of video kept from before recording starts, 0 turns it off
+    preroll_seconds = 5.0
+    preroll_max_bytes = 64 << 20
+    # Pipeline settings
+    stream_url = 'http://192.168.1.1:8080/?action=stream'
+    calib_file = 'robo_cam1.yaml'
+    faces_dir = 'Faces/Known'
+    unknown_faces_dir = 'Faces/Unknown'
+    screenshot_dir = 'Screenshots'
+    # jpg or png, burst rate in shots per second while a button is held, 0 for single shots
+    screenshot_format = 'jpg'
+    screenshot_quality = 90
+    screenshot_burst = 0.0
+    # read the MJPEG stream ourselves and keep each frame's JPEG bytes
+    use_mjpeg_reader = True
+    queue_size = 2
+    stats_interval = 1.0
+    # Display settings, the GUI sets display_size to its screen label
+    display_size = (640, 480)
+    display_enabled = True
+    # use the process pool shared by all robots for face detection
+    share_workers = False
+    # run face detection and ArUco in their own processes reading frames
+    # from shared memory, so they run side by side
+    use_frame_bus = False
+    bus_slots = 8
+    # Adaptive quality, see quality.QualityController
+    adaptive_quality = True
+    stream_control_url = None
+    # give up on the stream after this many failed reads in a row
+    max_read_failures = 100
+    # Metrics, estimated camera + network delay before capture and
+    # optional files the stats are dumped to every stats_interval
+    upstream_latency = 0.0
+    metrics_jsonl = None
+    metrics_prom = None
+    # robot label of this engine's metrics, set by the robot link
+    robot_name = None
+    # sessionlog.SessionLog getting marker events, face matches and recordings
+    session_log = None
+
+    def __init__(self):
+        self.running = False
+        self.stages = []
+        self.cap = None
+        # watched by the connection supervisor, a frame was captured and
+        # a frame came out of the end of the pipeline
+        self.last_frame_t = time.monotonic()
+        self.last_output_t = self.last_frame_t
+        self.frames_seen = 0
+        self.read_failures = 0
+        # set up on the first toggle of face or AR mode
+        self.face_worker = None
+        self.face_db = None
+        self.face_loader = None
+        self.face_capture = None
+        self.marker_tracker = None
+        self.marker_detector = None
+        self.aruco_worker = None
+        self.frame_bus = None
+
+    # ==================================================================
+    # Hooks for the front end, called from the pipeline threads
+
+    def ready(self, ok):
+        # the stream was opened, or could not be
+        pass
+
+    def show_frame(self, pkt):
+        # hand an annotated frame to the front end, False if it was dropped
+        return False
+
+    def publish_stats(self, stats):
+        pass
+
+    def publish_marker(self, event, marker_id):
+        pass
+
+    # ==================================================================
+
+    def load_faces(self):
+        # importing face_recognition and encoding new known faces can take
+        # minutes, so it happens off the pipeline, faces show up once done
+        if self.face_loader is None or not self.face_loader.is_alive():
+            self.face_loader = threading.Thread(target=self.init_faces, name='face-loader', daemon=True)
+            self.face_loader.start()
+
+    def init_faces(self):
+        # runs on the face loader thread
+        global faces
+        try:
+            if faces is None:
+                log.info("Loading face recognition")
+                import faces
+            # encodings come from the on-disk cache, only new images are encoded
+            face_db = faces.FaceDatabase(self.faces_dir)
+            face_index = face_db.load()
+        except Exception as e:
+            log.error("Could not load known faces from %s: %s", self.faces_dir, e)
+            self.do_face_recog = False
+            return
+        if self.use_frame_bus:
+            worker = framebus.Analyzer('face_detect', 'faces.analyzer', robot=self.robot_name)
+        else:
+            worker = faces.FaceWorker(shared=self.share_workers, robot=self.robot_name)
+        self.face_tracker = faces.FaceTracker()
+        self.face_locations = []
+        self.face_encodings = []
+        self.face_names = []
+        self.face_db = face_db
+        self.face_index = face_index
+        face_db.watch(self.set_face_index)
+        if not self.running:
+            # the engine stopped while we were loading
+            worker.close()
+            face_db.stop()
+            return
+        log.info("Face recognition ready")
+        # set last, the analysis stage starts using faces once it is set
+        self.face_worker = worker
+
+    def init_markers(self):
+        global markers
+        if markers is None:
+            log.info("Loading ArUco")
+            import markers
+        self.marker_detector = markers.MarkerDetector()
+        self.last_markers = None
+        if self.use_frame_bus:
+            self.aruco_worker = framebus.Analyzer('aruco', 'markers.analyzer', (self.cam_mat, self.dist_mat),
+                                                 robot=self.robot_name)
+        tracker = markers.MarkerTracker()
+        tracker.add_callback(self.marker_event)
+        # set last, the marker follower polls for it
+        self.marker_tracker = tracker
+
+    def set_face_index(self, index):
+        # called from the face database watcher
+        self.face_index = index
+
+    def bus_slot(self, pkt):
+        # the frame is copied to the bus once, every analyzer reads that copy
+        if pkt.slot is None:
+            if self.frame_bus is None or not self.frame_bus.fits(pkt.rgb):
+                if self.frame_bus is not None:
+                    self.frame_bus.close()
+                self.frame_bus = framebus.FrameBus(pkt.rgb.nbytes, self.bus_slots)
+            pkt.slot = self.frame_bus.write(pkt.seq, pkt.rgb)
+        return pkt.slot
+
+    def find_markers( self, img, mtx, dist, scale=1.0 ):
+        return markers.find_markers(self.marker_detector, img, mtx, dist, scale)
+
+    def draw_markers( self, img, found, mtx, dist ):
+        corners, ids, rvec, tvec = found
+        if not np.all(ids != None):
+            return
+
+        # set font for displaying
+        font = cv2.FONT_HERSHEY_SIMPLEX
+
+        for i in range(0, ids.size):
+            markers.aruco.drawAxis(img, mtx, dist, rvec[i], tvec[i], 0.1)
+            # label each marker
+            topc = corners[i][0][0]
+            topc_x, topc_y = int(topc[0]), int(topc[1])
+            cv2.putText(img, 'id:'+str(ids[i][0]), (topc_x+10, topc_y+25), font, 0.4, (255,0,0), 1)
+
+        markers.aruco.drawDetectedMarkers(img, corners)
+
+    def draw_faces( self, img, found ):
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        for (top, right, bottom, left), name in found:
+            # Draw box
+            cv2.rectangle(img, (left, top), (right, bottom), (255,0,0), 1)
+            # Label name
+            cv2.rectangle(img, (left, bottom), (right, bottom+20), (255,0,0), cv2.FILLED)
+            cv2.putText(img, name, (left + 2, bottom + 13), font, 0.5, (255,255,255), 1)
+
+    def marker_event(self, event, marker_id):
+        # called by the marker tracker on the analysis thread
+        if event == 'appear':
+            log.info("New marker appeared: %s", marker_id)
+        elif event == 'return':
+            log.info("Marker returned: %s", marker_id)
+        else:
+            log.info("Marker disappeared: %s", marker_id)
+        if self.session_log is not None:
+            self.session_log.marker(event, marker_id)
+        self.publish_marker(event, marker_id)
+
+    # ==================================================================
+    # Pipeline stages, each runs on its own thread
+    # capture -> convert -> analysis -> overlay -> display
+
+    def capture_stage(self):
+        if self.use_mjpeg_reader:
+            # decoding is left to the convert stage
+            frame = None
+            jpeg = self.cap.read_jpeg()
+            if jpeg is None:
+                return self.read_failed()
+        else:
+            jpeg = None
+            ret, frame = self.cap.read()
+            if not ret:
+                return self.read_failed()
+        self.read_failures = 0
+        self.last_frame_t = time.monotonic()
+        self.frames_seen += 1
+        if self.frames_seen == 1:
+            # the rest of the pipeline gets its time from the first frame
+            self.last_output_t = self.last_frame_t
+        self.seq += 1
+        pkt = pipeline.Packet(self.seq, frame)
+        pkt.jpeg = jpeg
+        # record here so every captured frame reaches the file
+        with metrics.timer('record', self.robot_name):
+            self.update_recording(pkt)
+        return pkt
+
+    def read_failed(self):
+        self.read_failures += 1
+        if self.read_failures >= self.max_read_failures and self.running:
+            # the stream is gone, end the thread so it can be restarted
+            log.warning("Video stream lost after %d failed reads", self.read_failures)
+            self.running = False
+        return None
+
+    def update_recording(self, pkt):
+        if self.preroll is not None and self.recorder is None:
+            if pkt.jpeg is None:
+                ok, buf = cv2.imencode('.jpg', pkt.frame)
+                pkt.jpeg = buf.tobytes() if ok else None
+            if pkt.jpeg is not None:
+                self.preroll.add(pkt.t_capture, pkt.jpeg)
+        if self.recorder is not None:
+            if self.should_record_video:
+                # save next frame
+                self.recorder.write(pkt.t_capture, pkt.frame, pkt.jpeg)
+            else:
+                # stop and save, the writer finishes in the background
+                self.recorder.stop(wait=False)
+                self.recorder = None
+        elif self.should_record_video:
+            # start recording
+            log.info("Starting Recording")
+            timestamp = datetime.datetime.now().strftime('%d%b_%H:%M:%S')
+            # use the measured capture rate so the file plays in real time
+            fps = self.stages[0].meter.fps if self.stages else 0
+            if fps < 1:
+                fps = self.record_fps
+            self.recorder = recorder.Recorder('Videos/vid_'+timestamp, fps, self.record_codec)
+            t_start = pkt.t_capture
+            if self.preroll is not None:
+                log.info("Pre-roll: %s", self.preroll.stats())
+                # the newest pre-roll frame is this one, it is written below
+                frames = self.preroll.take()[:-1]
+                self.recorder.preload(frames)
+                if frames:
+                    t_start = frames[0][0]
+            if self.session_log is not None:
+                # the file's first frame is the first one the recorder gets
+                self.session_log.video(self.recorder.path, t_start, fps)
+            self.recorder.start()
+            self.recorder.write(pkt.t_capture, pkt.frame, pkt.jpeg)
+
+    def convert_stage(self, pkt):
+        if pkt.frame is None:
+            pkt.frame = cv2.imdecode(np.frombuffer(pkt.jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if pkt.frame is None:
+                return None
+        pkt.rgb = cv2.cvtColor(pkt.frame, cv2.COLOR_BGR2RGB)
+        self.frame_shape = pkt.rgb.shape
+        return pkt
+
+    def analysis_stage(self, pkt):
+        t0 = time.monotonic()
+        # under load only every nth frame is analysed
+        analyze = not self.adaptive_quality or self.quality.should_analyze()
+        if self.do_aruco:
+            if self.marker_detector is None:
+                self.init_markers()
+            if self.aruco_worker is not None:
+                # results come back a frame or two later, tracked under
+                # the capture time of the frame they were found on
+                res = self.aruco_worker.poll()
+                if res is not None:
+                    found, ar_ids, t = res
+                    corners, ids, rvec, tvec = found
+                    self.marker_tracker.update(ar_ids, rvec, tvec, t)
+                    self.last_markers = found
+                if analyze and self.aruco_worker.ready():
+                    slot = self.bus_slot(pkt)
+                    if slot is not None:
+                        self.aruco_worker.submit(self.frame_bus, slot, pkt.seq,
+                                                 (self.quality.aruco_scale,), pkt.t_capture)
+                pkt.markers = self.last_markers
+            elif analyze:
+                with metrics.timer('aruco', self.robot_name):
+                    pkt.markers, ar_ids = self.find_markers( pkt.rgb, self.cam_mat, self.dist_mat,
+                                                             self.quality.aruco_scale )
+                    corners, ids, rvec, tvec = pkt.markers
+                    self.marker_tracker.update(ar_ids, rvec, tvec, pkt.t_capture)
+                self.last_markers = pkt.markers
+            else:
+                pkt.markers = self.last_markers
+        elif self.marker_detector is not None and (self.marker_detector.rois or self.last_markers is not None):
+            self.marker_detector.reset()
+            if self.aruco_worker is not None:
+                self.aruco_worker.cancel()
+            self.last_markers = None
+
+        # Face Recognition
+        if self.do_face_recog and self.face_worker is None:
+            self.load_faces()
+        if self.do_face_recog and self.face_worker is not None:
+            gray = cv2.cvtColor(pkt.rgb, cv2.COLOR_RGB2GRAY)
+            # pick up finished detections, they were run on an older frame
+            res = self.face_worker.poll()
+            if res is not None:
+                locations, self.face_encodings, (det_gray, det_scale, det_frame) = res
+                # boxes were found on a downscaled frame
+                locations = [quality.scale_box(loc, 1.0 / det_scale) for loc in locations]
+                self.face_tracker.reset(det_gray, locations)
+                # match once per detection, boxes keep their names while tracked
+                with metrics.timer('face_match', self.robot_name):
+                    names = self.face_index.match(self.face_encodings)
+                if self.session_log is not None:
+                    # only faces that were not matched last time
+                    seen = set(name for name, dist in self.face_names)
+                    for name, dist in names:
+                        if name not in seen:
+                            self.session_log.face(name, dist)
+                self.face_names = names
+                log.debug("Faces: %s %s", locations, self.face_names)
+                if det_frame is not None and self.face_capture is not None:
+                    # crops come from the frame the encodings were computed on
+                    for (top, right, bottom, left), enc, (name, dist) in \
+                            zip(locations, self.face_encodings, self.face_names):
+                        self.face_capture.add(det_frame[max(top, 0):bottom, max(left, 0):right], enc, name)
+            # move boxes along with the faces until the next detection
+            with metrics.timer('face_track', self.robot_name):
+                self.face_locations = self.face_tracker.update(gray)
+            if self.face_worker.ready():
+                # resize and the bus both make a new image, so the overlay cannot draw on it
+                fs = self.quality.face_scale
+                context = (gray, fs, pkt.frame if self.save_face else None)
+                if self.use_frame_bus:
+                    # the analyzer scales the frame itself
+                    slot = self.bus_slot(pkt)
+                    if slot is not None:
+                        self.face_worker.submit(self.frame_bus, slot, pkt.seq, (fs,), context)
+                else:
+                    small = cv2.resize(pkt.rgb, None, fx=fs, fy=fs, interpolation=cv2.INTER_AREA)
+                    self.face_worker.submit(small, context)
+
+            for loc, (name, dist) in zip(self.face_locations, self.face_names):
+                pkt.faces.append((loc, name))
+        elif self.face_worker is not None and (self.face_locations or self.face_worker.future is not None):
+            self.face_worker.cancel()
+            self.face_tracker.clear()
+            self.face_locations = []
+            self.face_encodings = []
+            self.face_names = []
+
+        # Remember Faces session runs while the button is held
+        if self.save_face and self.face_capture is None and self.face_worker is not None:
+            log.debug("Capturing faces")
+            self.face_capture = faces.FaceCapture(self.unknown_faces_dir)
+        elif not self.save_face and self.face_capture is not None:
+            self.face_capture.close()
+            self.face_capture = None
+
+        if analyze and self.adaptive_quality and (self.do_aruco or self.do_face_recog):
+            if self.quality.observe(time.monotonic() - t0) and self.marker_detector is not None:
+                # ROIs are in the old detection resolution
+                self.marker_detector.reset()
+        return pkt
+
+    def overlay_stage(self, pkt):
+        frame, rgbImage = pkt.frame, pkt.rgb
+        if pkt.markers is not None:
+            self.draw_markers(rgbImage, pkt.markers, self.cam_mat, self.dist_mat)
+        self.draw_faces(rgbImage, pkt.faces)
+
+        # Screenshots are encoded and written on the screenshot pool
+        if self.screenshots.due('clean', self.should_save_screenshot1):
+            log.info("Save screenshot 1")
+            self.screenshots.capture(frame, jpeg=pkt.jpeg)
+        if self.screenshots.due('overlay', self.should_save_screenshot2):
+            log.info("Save screenshot 2")
+            self.screenshots.capture(rgbImage, rgb=True)
+
+        return pkt
+
+    def stage_stats(self):
+        stats = {}
+        for s in self.stages:
+            stats[s.name] = s.stats()
+        if self.preroll is not None:
+            stats['preroll'] = self.preroll.stats()
+        stats['display'] = {
+            'fps': round(self.display_meter.fps, 1),
+            'frames': self.display_meter.count,
+            'dropped': self.display_q.dropped,
+        }
+        return stats
+
+    def stop(self):
+        self.running = False
+        for s in self.stages:
+            s.stop()
+        # the capture stage may be blocked in a read, cut it short
+        cap = self.cap
+        if cap is not None and hasattr(cap, 'interrupt'):
+            cap.interrupt()
+
+    def run(self):
+        self.running = True
+        self.stages = []
+        self.last_frame_t = time.monotonic()
+        if self.use_mjpeg_reader:
+            cap = mjpeg.MjpegReader()
+        else:
+            cap = cv2.VideoCapture()
+        r = cap.open(self.stream_url)
+        if not r:
+            log.error("Could not open video stream %s", self.stream_url)
+            self.ready(False)
+            return
+        else:
+            self.ready(True)
+        self.cap = cap
+        self.seq = 0
+
+        # Video recording
+        self.recorder = None
+        self.preroll = None
+        if self.preroll_seconds > 0:
+            self.preroll = recorder.PreRoll(self.preroll_seconds, self.preroll_max_bytes)
+
+        # Screenshots
+        self.screenshots = screenshots.ScreenshotService(self.screenshot_dir, self.screenshot_format,
+                                                         self.screenshot_quality, self.screenshot_burst,
+                                                         robot=self.robot_name)
+
+        self.quality = quality.QualityController()
+        self.quality.stream_control_url = self.stream_control_url
+        self.frame_shape = None
+        tmp_file = cv2.FileStorage(self.calib_file, cv2.FILE_STORAGE_READ)
+        self.cam_mat = tmp_file.getNode('camera_matrix').mat()
+        self.dist_mat = tmp_file.getNode('dist_coeeff').mat()
+        tmp_file.release()
+
+        # Build pipeline, queues drop the oldest frame when full
+        convert_q = pipeline.FrameQueue(self.queue_size)
+        analysis_q = pipeline.FrameQueue(self.queue_size)
+        overlay_q = pipeline.FrameQueue(self.queue_size)
+        self.display_q = pipeline.FrameQueue(self.queue_size)
+        self.display_meter = pipeline.Meter()
+        self.stages = [
+            pipeline.Stage('capture', self.capture_stage, None, convert_q, self.robot_name),
+            pipeline.Stage('convert', self.convert_stage, convert_q, analysis_q, self.robot_name),
+            pipeline.Stage('analysis', self.analysis_stage, analysis_q, overlay_q, self.robot_name),
+            pipeline.Stage('overlay', self.overlay_stage, overlay_q, self.display_q, self.robot_name),
+        ]
+        for s in self.stages:
+            s.start()
+
+        # Display stage runs on this thread
+        last_stats = time.monotonic()
+        while self.running:
+            pkt = self.display_q.get(0.1)
+            if pkt is not None:
+                self.last_output_t = time.monotonic()
+                if self.display_enabled and self.show_frame(pkt):
+                    self.display_meter.tick()
+
+            now = time.monotonic()
+            if now - last_stats >= self.stats_interval:
+                last_stats = now
+                stats = self.stage_stats()
+                log.debug("Pipeline: %s", stats)
+                # frame budget follows the capture rate
+                fps = stats['capture']['fps']
+                self.quality.set_fps(fps)
+                if self.quality.base_mode is None and self.frame_shape is not None and fps >= 1:
+                    h, w = self.frame_shape[:2]
+                    self.quality.set_stream_mode(w, h, int(round(fps)))
+                metrics.gauge('quality_level', self.quality.level, self.robot_name)
+                for name, st in stats.items():
+                    if 'fps' in st:
+                        metrics.gauge('fps_'+name, st['fps'], self.robot_name)
+                    if 'dropped' in st:
+                        metrics.gauge('dropped_'+name, st['dropped'], self.robot_name)
+                if self.metrics_jsonl:
+                    metrics.REGISTRY.write_jsonl(self.metrics_jsonl)
+                if self.metrics_prom:
+                    metrics.REGISTRY.write_prometheus(self.metrics_prom)
+                self.publish_stats(stats)
+
+        self.stop()
+        for s in self.stages:
+            s.join(1.0)
+        if self.face_worker is not None:
+            self.face_worker.close()
+            self.face_db.stop()
+            self.face_worker = None
+        if self.face_capture is not None:
+            self.face_capture.close()
+            self.face_capture = None
+        if self.aruco_worker is not None:
+            self.aruco_worker.close()
+            self.aruco_worker = None
+            self.marker_detector = None
+        if self.frame_bus is not None:
+            self.frame_bus.close()
+            self.frame_bus = None
+        self.screenshots.close()
+        if self.recorder is not None:
+            self.recorder.stop()
+        self.cap = None
+        cap.release()
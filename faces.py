@@ -0,0 +1,481 @@
+# faces.py
+# Face detection worker and tracking of faces between detections
+
+import concurrent.futures
+import hashlib, json, logging, multiprocessing, os, shutil, threading
+import time
+import cv2
+import numpy as np
+import face_recognition
+import metrics
+
+log = logging.getLogger(__name__)
+
+# workers are started fresh, forking a process that runs Qt and pipeline
+# threads can leave a child stuck on a lock held at fork time
+mp = multiprocessing.get_context('spawn')
+
+
+def detect_faces(rgb):
+    # runs inside a worker process
+    locations = face_recognition.face_locations(rgb)
+    encodings = face_recognition.face_encodings(rgb, locations)
+    return locations, encodings
+
+
+def analyzer():
+    # frame bus analyzer, see framebus.Analyzer
+    def analyze(rgb, scale):
+        small = cv2.resize(rgb, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return detect_faces(small)
+    return analyze
+
+
+_shared_pool = None
+
+
+def shared_pool():
+    # one process pool for every video thread, sized to the machine
+    global _shared_pool
+    if _shared_pool is None:
+        workers = max(1, (os.cpu_count() or 2) - 1)
+        _shared_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp)
+    return _shared_pool
+
+
+class FaceWorker(object):
+    # runs detect_faces in a process pool, only one frame is in flight
+    # so the worker always handles the latest frame it was given
+    min_interval = 0.1
+    # wait this many worker latencies between jobs, 1.0 keeps it busy
+    spacing = 1.0
+
+    def __init__(self, workers=1, shared=False, robot=None):
+        self.workers = workers
+        self.shared = shared
+        self.robot = robot
+        self.pool = None
+        self.future = None
+        self.context = None
+        self.submitted = 0.0
+        self.latency = None
+
+    def interval(self):
+        if self.latency is None:
+            return self.min_interval
+        return max(self.min_interval, self.latency * self.spacing)
+
+    def ready(self):
+        if self.future is not None:
+            return False
+        return time.monotonic() - self.submitted >= self.interval()
+
+    def submit(self, rgb, context=None):
+        if self.pool is None:
+            if self.shared:
+                self.pool = shared_pool()
+            else:
+                self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                                  mp_context=mp)
+        self.submitted = time.monotonic()
+        self.context = context
+        self.future = self.pool.submit(detect_faces, rgb)
+
+    def poll(self):
+        # returns (locations, encodings, context) once the job is done
+        if self.future is None or not self.future.done():
+            return None
+        fut, self.future = self.future, None
+        dt = time.monotonic() - self.submitted
+        metrics.observe('face_detect', dt, self.robot)
+        if self.latency is None:
+            self.latency = dt
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * dt
+        try:
+            locations, encodings = fut.result()
+        except Exception as e:
+            log.error("Face worker failed: %s", e)
+            return None
+        return locations, encodings, self.context
+
+    def cancel(self):
+        # forget the job in flight, its result is stale
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+
+    def close(self):
+        self.cancel()
+        if self.pool is not None and not self.shared:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = None
+
+
+class FaceTracker(object):
+    # moves face boxes with the image using sparse optical flow
+    max_points = 20
+
+    def __init__(self):
+        self.prev_gray = None
+        self.boxes = []
+        self.points = []
+
+    def reset(self, gray, locations):
+        # start tracking from the frame the detection ran on
+        self.prev_gray = gray
+        self.boxes = []
+        self.points = []
+        for top, right, bottom, left in locations:
+            mask = np.zeros_like(gray)
+            mask[top:bottom, left:right] = 255
+            pts = cv2.goodFeaturesToTrack(gray, self.max_points, 0.01, 3, mask=mask)
+            self.boxes.append([float(top), float(right), float(bottom), float(left)])
+            self.points.append(pts)
+
+    def update(self, gray):
+        if self.prev_gray is not None and self.prev_gray is not gray:
+            for i, pts in enumerate(self.points):
+                if pts is None or len(pts) == 0:
+                    continue
+                new_pts, st, err = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, pts, None)
+                if new_pts is None:
+                    self.points[i] = None
+                    continue
+                good = st.reshape(-1) == 1
+                if not good.any():
+                    self.points[i] = None
+                    continue
+                dx, dy = np.median((new_pts - pts)[good].reshape(-1, 2), axis=0)
+                box = self.boxes[i]
+                box[0] += dy; box[2] += dy
+                box[1] += dx; box[3] += dx
+                self.points[i] = new_pts[good].reshape(-1, 1, 2)
+        self.prev_gray = gray
+        return self.locations(gray.shape)
+
+    def locations(self, shape):
+        h, w = shape[:2]
+        locs = []
+        for top, right, bottom, left in self.boxes:
+            top = min(max(int(round(top)), 0), h)
+            bottom = min(max(int(round(bottom)), 0), h)
+            left = min(max(int(round(left)), 0), w)
+            right = min(max(int(round(right)), 0), w)
+            locs.append((top, right, bottom, left))
+        return locs
+
+    def clear(self):
+        self.prev_gray = None
+        self.boxes = []
+        self.points = []
+
+
+class FaceIndex(object):
+    # known faces as one float32 matrix, matched in a single batch
+    tolerance = 0.6
+    # past this many faces use an approximate index if hnswlib exists
+    ann_threshold = 5000
+
+    def __init__(self, names=(), encodings=()):
+        self.names = list(names)
+        self.matrix = np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(-1, 128))
+        self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.ann = None
+        if len(self.names) >= self.ann_threshold:
+            self.ann = self.build_ann()
+
+    def __len__(self):
+        return len(self.names)
+
+    def build_ann(self):
+        try:
+            import hnswlib
+        except ImportError:
+            log.warning("hnswlib not installed, using exact face matching")
+            return None
+        n = len(self.names)
+        idx = hnswlib.Index(space='l2', dim=128)
+        idx.init_index(max_elements=n, ef_construction=200, M=16)
+        idx.add_items(self.matrix, np.arange(n))
+        idx.set_ef(50)
+        return idx
+
+    def nearest(self, query):
+        # index and euclidean distance of the closest known face per row
+        if self.ann is not None:
+            labels, d2 = self.ann.knn_query(query, k=1)
+            return labels[:, 0], np.sqrt(np.maximum(d2[:, 0], 0))
+        q_norms = np.einsum('ij,ij->i', query, query)
+        d2 = q_norms[:, None] + self.sq_norms[None, :] - 2.0 * (query @ self.matrix.T)
+        best = np.argmin(d2, axis=1)
+        return best, np.sqrt(np.maximum(d2[np.arange(len(best)), best], 0))
+
+    def match(self, encodings):
+        # returns a (name, distance) pair for each encoding
+        if len(encodings) == 0:
+            return []
+        if len(self.names) == 0:
+            return [('Unknown', None)] * len(encodings)
+        query = np.asarray(encodings, dtype=np.float32).reshape(-1, 128)
+        best, dist = self.nearest(query)
+        matches = []
+        for i, d in zip(best, dist):
+            name = self.names[i] if d <= self.tolerance else 'Unknown'
+            matches.append((name, float(d)))
+        return matches
+
+
+class FaceCapture(object):
+    # one "Remember Faces" session, crops are grouped by person using
+    # their encodings, near duplicates are dropped and only the sharpest
+    # few per person are kept until the session is written out
+    keep = 5
+    # encodings closer than this belong to the same person
+    same_person = 0.5
+    # crops of one person closer than this are duplicates
+    duplicate = 0.15
+
+    def __init__(self, folder='Faces/Unknown'):
+        self.folder = os.path.join(folder, time.strftime('session_%Y%m%d_%H%M%S'))
+        # person -> (first encoding, known name, [(sharpness, crop, encoding)])
+        self.people = []
+        self.seen = 0
+        self.duplicates = 0
+        self.writer = None
+
+    @staticmethod
+    def sharpness(crop):
+        # variance of the laplacian, blurry crops score low
+        gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+        return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+    def add(self, crop, encoding, name='Unknown'):
+        if crop.size == 0:
+            return
+        self.seen += 1
+        encoding = np.asarray(encoding, dtype=np.float32)
+        person = None
+        for p in self.people:
+            if np.linalg.norm(p[0] - encoding) <= self.same_person:
+                person = p
+                break
+        if person is None:
+            person = (encoding, name, [])
+            self.people.append(person)
+        crops = person[2]
+        score = self.sharpness(crop)
+        for i, (s, c, e) in enumerate(crops):
+            if np.linalg.norm(e - encoding) <= self.duplicate:
+                self.duplicates += 1
+                if score > s:
+                    crops[i] = (score, crop.copy(), encoding)
+                    crops.sort(key=lambda x: -x[0])
+                return
+        if len(crops) < self.keep or score > crops[-1][0]:
+            crops.append((score, crop.copy(), encoding))
+            crops.sort(key=lambda x: -x[0])
+            del crops[self.keep:]
+
+    def close(self):
+        # writes the session on a background thread, returns at once
+        if self.writer is None and self.people:
+            self.writer = threading.Thread(target=self.write, name='face-capture', daemon=True)
+            self.writer.start()
+
+    def write(self):
+        os.makedirs(self.folder, exist_ok=True)
+        entries, encodings = [], []
+        for n, (first, name, crops) in enumerate(self.people):
+            person = 'person%d' % n
+            for k, (score, crop, encoding) in enumerate(crops):
+                fname = '%s_%d.png' % (person, k)
+                cv2.imwrite(os.path.join(self.folder, fname), crop)
+                entries.append({'file': fname, 'person': person, 'name': name,
+                                'sharpness': round(score, 1), 'row': len(encodings)})
+                encodings.append(encoding)
+        np.save(os.path.join(self.folder, 'encodings.npy'), np.asarray(encodings, dtype=np.float32))
+        with open(os.path.join(self.folder, 'capture.json'), 'w') as f:
+            json.dump(entries, f, indent=1)
+        log.info("Saved %d faces of %d people to %s (%d seen, %d duplicates)",
+                 len(entries), len(self.people), self.folder, self.seen, self.duplicates)
+
+    def wait(self):
+        if self.writer is not None:
+            self.writer.join()
+
+
+class FaceDatabase(object):
+    # known faces listed in faces.txt, encodings are cached on disk in
+    # encodings.npy (one float32 row per image) and encodings.json
+    # (image file -> row, mtime, size and sha1) so only new or changed
+    # images are encoded again
+    def __init__(self, folder='Faces/Known'):
+        self.folder = folder
+        self.list_file = os.path.join(folder, 'faces.txt')
+        self.matrix_file = os.path.join(folder, 'encodings.npy')
+        self.index_file = os.path.join(folder, 'encodings.json')
+        self.stamp = None
+        self.watcher = None
+        self.watching = False
+
+    def read_list(self):
+        entries = []
+        with open(self.list_file, 'r') as ff:
+            for line in ff.readlines():
+                tmp = (line.rstrip()).split(' ')
+                if len(tmp) != 2:
+                    break
+                entries.append((tmp[0], tmp[1]))
+        return entries
+
+    def file_hash(self, path):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def encode(self, path):
+        img = face_recognition.load_image_file(path)
+        encods = face_recognition.face_encodings(img)
+        if not encods:
+            log.warning("No face found in %s", path)
+            return None
+        return encods[0]
+
+    def load_cache(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+            matrix = np.load(self.matrix_file, mmap_mode='r')
+        except (OSError, ValueError):
+            return {}
+        cache = {}
+        for fname, entry in index.items():
+            if 0 <= entry['row'] < len(matrix):
+                cache[fname] = (entry, matrix[entry['row']])
+        return cache
+
+    def save_cache(self, cache):
+        files = sorted(cache)
+        matrix = np.zeros((len(files), 128), dtype=np.float32)
+        index = {}
+        for row, fname in enumerate(files):
+            entry, encod = cache[fname]
+            matrix[row] = encod
+            index[fname] = dict(entry, row=row)
+        # write to temp files first so a crash never leaves half a cache
+        tmp_matrix = self.matrix_file + '.tmp.npy'
+        tmp_index = self.index_file + '.tmp'
+        np.save(tmp_matrix, matrix)
+        with open(tmp_index, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_matrix, self.matrix_file)
+        os.replace(tmp_index, self.index_file)
+
+    def load(self):
+        # returns a FaceIndex, encoding only what the cache is missing
+        old = self.load_cache()
+        cache = {}
+        names, encodings = [], []
+        dirty = False
+        for name, fname in self.read_list():
+            path = os.path.join(self.folder, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                log.warning("Missing face image %s", path)
+                continue
+            if fname not in cache:
+                entry, encod = old.get(fname, (None, None))
+                if entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+                    digest = self.file_hash(path)
+                    if entry is None or entry['sha1'] != digest:
+                        encod = self.encode(path)
+                        if encod is None:
+                            continue
+                    entry = {'mtime': st.st_mtime, 'size': st.st_size, 'sha1': digest}
+                    dirty = True
+                cache[fname] = (entry, np.asarray(encod, dtype=np.float32))
+            names.append(name)
+            encodings.append(cache[fname][1])
+        if dirty or set(cache) != set(old):
+            self.save_cache(cache)
+        self.stamp = self.snapshot()
+        return FaceIndex(names, encodings)
+
+    def enroll(self, session, person, name):
+        # copies a FaceCapture person into the known faces, their
+        # encodings go straight into the cache so nothing is encoded again
+        with open(os.path.join(session, 'capture.json'), 'r') as f:
+            entries = [e for e in json.load(f) if e['person'] == person]
+        if not entries:
+            raise ValueError("No %s in %s" % (person, session))
+        matrix = np.load(os.path.join(session, 'encodings.npy'))
+        cache = self.load_cache()
+        lines = []
+        for entry in entries:
+            fname = '%s_%s_%s' % (name, os.path.basename(session.rstrip(os.sep)), entry['file'])
+            path = os.path.join(self.folder, fname)
+            shutil.copyfile(os.path.join(session, entry['file']), path)
+            st = os.stat(path)
+            cache[fname] = ({'mtime': st.st_mtime, 'size': st.st_size, 'sha1': self.file_hash(path)},
+                            matrix[entry['row']])
+            lines.append('%s %s\n' % (name, fname))
+        self.save_cache(cache)
+        with open(self.list_file, 'a') as f:
+            f.writelines(lines)
+        return len(lines)
+
+    def snapshot(self):
+        # cheap fingerprint of faces.txt and the images it lists
+        stamp = []
+        try:
+            stamp.append(os.stat(self.list_file).st_mtime)
+            for name, fname in self.read_list():
+                try:
+                    stamp.append(os.stat(os.path.join(self.folder, fname)).st_mtime)
+                except OSError:
+                    stamp.append(None)
+        except OSError:
+            pass
+        return tuple(stamp)
+
+    def changed(self):
+        return self.snapshot() != self.stamp
+
+    def watch(self, callback, interval=2.0):
+        # reload in the background and hand the new FaceIndex to callback
+        def loop():
+            while self.watching:
+                time.sleep(interval)
+                if self.watching and self.changed():
+                    log.info("Reloading known faces")
+                    try:
+                        index = self.load()
+                    except Exception as e:
+                        # e.g. faces.txt mid-save, the stamp is unchanged
+                        # so the next poll tries again, keep the old index
+                        log.warning("Could not reload known faces: %s", e)
+                        continue
+                    callback(index)
+        self.watching = True
+        self.watcher = threading.Thread(target=loop, name='face-db', daemon=True)
+        self.watcher.start()
+
+    def stop(self):
+        self.watching = False
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Enroll a person from a Remember Faces session')
+    parser.add_argument('session', help='session folder under Faces/Unknown')
+    parser.add_argument('person', help='person in the session, e.g. person0')
+    parser.add_argument('name', help='name to enroll them as')
+    parser.add_argument('--known', default='Faces/Known', help='known faces folder')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    n = FaceDatabase(args.known).enroll(args.session, args.person, args.name)
+    log.info("Enrolled %d images of %s", n, args.name)
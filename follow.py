@@ -0,0 +1,162 @@
+# follow.py
+# Closed-loop marker following, points the camera at a marker with the
+# pan/tilt servos and drives the robot toward it
+
+import logging, math, threading, time
+import metrics
+from robot_protocol import RobotProtocol
+
+log = logging.getLogger(__name__)
+
+
+class PID(object):
+    # PID with output clamp and a limit on how fast the output may change
+    def __init__(self, kp, ki=0.0, kd=0.0, limit=None, slew=None):
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.limit = limit
+        self.slew = slew
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.prev_error = None
+        self.output = 0.0
+
+    def update(self, error, dt):
+        if dt <= 0:
+            return self.output
+        self.integral += error * dt
+        deriv = 0.0 if self.prev_error is None else (error - self.prev_error) / dt
+        self.prev_error = error
+        out = self.kp * error + self.ki * self.integral + self.kd * deriv
+        if self.limit is not None:
+            out = max(-self.limit, min(self.limit, out))
+            # keep the integral from winding up while saturated
+            if self.ki:
+                self.integral = max(-self.limit / self.ki, min(self.limit / self.ki, self.integral))
+        if self.slew is not None:
+            step = self.slew * dt
+            out = max(self.output - step, min(self.output + step, out))
+        self.output = out
+        return out
+
+
+class MarkerFollower(threading.Thread):
+    # wakes on every new pose from the video pipeline, so the loop runs at
+    # the analysis rate capped by max_rate
+    max_rate = 20.0
+    # degrees of camera angle that count as centred
+    deadband = 3.0
+    # pan servo offset from straight ahead before the robot turns instead
+    turn_threshold = 20
+    # metres, stop when the marker is closer than this
+    stop_distance = 0.3
+    # seconds without a pose before the robot stops
+    lost_timeout = 0.5
+    # flip these if the servos turn the wrong way
+    pan_sign = -1
+    tilt_sign = 1
+
+    def __init__(self, robot, marker_id, horz, vert, center_horz):
+        super(MarkerFollower, self).__init__(name='follower', daemon=True)
+        self.robot = robot
+        self.marker_id = marker_id
+        self.horz = float(horz)
+        self.vert = float(vert)
+        self.center_horz = center_horz
+        self.pan = PID(0.6, 0.05, 0.02, limit=15.0, slew=200.0)
+        self.tilt = PID(0.6, 0.05, 0.02, limit=15.0, slew=200.0)
+        self.drive = RobotProtocol.STOP
+        self.running = True
+
+    def tracker(self):
+        th = self.robot.th
+        return getattr(th, 'marker_tracker', None)
+
+    def send_drive(self, cmd):
+        # drive commands only go out when they change
+        if cmd != self.drive:
+            self.drive = cmd
+            self.robot.run_cmd(cmd)
+
+    def lost(self):
+        # stop driving and start the servos fresh on the next pose
+        if self.drive != RobotProtocol.STOP:
+            log.info("Marker %d lost, stopping", self.marker_id)
+        self.send_drive(RobotProtocol.STOP)
+        self.pan.reset()
+        self.tilt.reset()
+
+    def run(self):
+        version = 0
+        last_pose_t = None
+        last_step = 0.0
+        # capture time of the newest pose seen, its age decides when the
+        # marker counts as lost, even if no tracker update ever arrives
+        seen_t = time.monotonic()
+        while self.running:
+            tracker = self.tracker()
+            if tracker is None:
+                # the video thread is being replaced
+                time.sleep(0.1)
+                pose = None
+            else:
+                version = tracker.wait_update(version, 0.1)
+                pose = tracker.latest(self.marker_id)
+            if not self.running:
+                break
+            now = time.monotonic()
+            if pose is not None:
+                seen_t = max(seen_t, pose[0])
+            if now - seen_t > self.lost_timeout:
+                self.lost()
+                last_step = 0.0
+                continue
+            if pose is None or pose[0] == last_pose_t:
+                continue
+            # rate limit the control loop
+            if now - last_step < 1.0 / self.max_rate:
+                continue
+            dt = now - last_step if last_step else 1.0 / self.max_rate
+            last_step = now
+            last_pose_t = pose[0]
+            self.step(pose, dt)
+            # capture of the frame to command handed to the sender
+            metrics.observe('follow_loop', time.monotonic() - pose[0], self.robot.name)
+
+    def step(self, pose, dt):
+        t, rvec, tvec = pose
+        x, y, z = tvec
+        if z <= 0:
+            return
+        # angle of the marker off the camera axis
+        err_h = math.degrees(math.atan2(x, z))
+        err_v = math.degrees(math.atan2(y, z))
+        if abs(err_h) > self.deadband:
+            self.horz += self.pan_sign * self.pan.update(err_h, dt)
+        if abs(err_v) > self.deadband:
+            self.vert += self.tilt_sign * self.tilt.update(err_v, dt)
+        self.horz = max(0.0, min(RobotProtocol.SERVO_MAX, self.horz))
+        self.vert = max(0.0, min(RobotProtocol.SERVO_MAX, self.vert))
+        self.robot.run_cmd(RobotProtocol.horz(int(round(self.horz))))
+        self.robot.run_cmd(RobotProtocol.vert(int(round(self.vert))))
+
+        # turn the body toward where the camera is looking, then approach
+        offset = self.horz - self.center_horz
+        if abs(offset) > self.turn_threshold:
+            # a pan toward lower servo values means the marker is to the right
+            right = (offset < 0) == (self.pan_sign < 0)
+            self.send_drive(RobotProtocol.RIGHT if right else RobotProtocol.LEFT)
+        elif z > self.stop_distance:
+            self.send_drive(RobotProtocol.FORWARD)
+        else:
+            self.send_drive(RobotProtocol.STOP)
+
+    def stop(self):
+        # STOP override, wait out a step in progress so nothing it sends
+        # can land after the STOP
+        self.running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(0.5)
+        self.drive = RobotProtocol.STOP
+        self.robot.run_cmd(RobotProtocol.STOP)
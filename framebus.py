@@ -0,0 +1,215 @@
+# framebus.py
+# Shared memory ring of frames read by analyzer processes, so face
+# detection and ArUco run in parallel instead of one after the other
+
+import importlib, logging, multiprocessing, queue, time
+from multiprocessing import shared_memory
+import numpy as np
+import metrics
+
+log = logging.getLogger(__name__)
+
+# analyzers are started fresh rather than forked from a process full of
+# GUI and pipeline threads
+mp = multiprocessing.get_context('spawn')
+
+
+class FrameBus(object):
+    # slots of capacity bytes each, a slot is written once and read in
+    # place by every analyzer, slots held by a job are never overwritten
+    # per slot header: seq, height, width, channels
+    HEADER = 4
+
+    def __init__(self, capacity, slots=8, name=None):
+        self.capacity = capacity
+        self.slots = slots
+        size = slots * (self.HEADER * 8 + capacity)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.shm = attach(name)
+            self.owner = False
+        self.name = self.shm.name
+        self.header = np.ndarray((slots, self.HEADER), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray((slots, capacity), dtype=np.uint8, buffer=self.shm.buf,
+                               offset=self.header.nbytes)
+        if self.owner:
+            self.header[:] = 0
+        self.holds = [0] * slots
+        self.next = 0
+
+    def fits(self, frame):
+        return frame.nbytes <= self.capacity
+
+    def write(self, seq, frame):
+        # copies frame into a free slot, returns the slot or None if all are held
+        for i in range(self.slots):
+            slot = (self.next + i) % self.slots
+            if not self.holds[slot]:
+                break
+        else:
+            return None
+        self.next = slot + 1
+        h, w = frame.shape[:2]
+        c = frame.shape[2] if frame.ndim == 3 else 1
+        hdr = self.header[slot]
+        # readers check the sequence number, mark the slot as changing
+        hdr[0] = -1
+        self.data[slot, :frame.nbytes].reshape(frame.shape)[...] = frame
+        hdr[1:] = (h, w, c)
+        hdr[0] = seq
+        return slot
+
+    def view(self, slot, seq):
+        # the frame in slot without copying, None if it is no longer seq
+        hdr = self.header[slot]
+        if hdr[0] != seq:
+            return None
+        h, w, c = (int(v) for v in hdr[1:])
+        shape = (h, w, c) if c > 1 else (h, w)
+        return self.data[slot, :h * w * c].reshape(shape)
+
+    def valid(self, slot, seq):
+        return self.header[slot, 0] == seq
+
+    def hold(self, slot):
+        self.holds[slot] += 1
+
+    def release(self, slot):
+        if self.holds[slot]:
+            self.holds[slot] -= 1
+
+    def close(self):
+        # drop the numpy views first, the buffer cannot close while they exist
+        self.header = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def attach(name):
+    # open an existing block, the owner unlinks it
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before 3.13 attaching registers the block again, analyzers are
+        # spawned and share the owner's resource tracker, so that only
+        # repeats its registration, unregistering here would drop it
+        return shared_memory.SharedMemory(name=name)
+
+
+def analyzer_main(factory, args, jobs, results):
+    # runs in the analyzer process, factory is 'module.function' and
+    # returns analyze(frame, *params), modules load here and not in the GUI
+    module, name = factory.rsplit('.', 1)
+    analyze = getattr(importlib.import_module(module), name)(*args)
+    bus = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, bus_name, capacity, slots, slot, seq, params = job
+        if bus is None or bus.name != bus_name:
+            if bus is not None:
+                bus.close()
+                bus = None
+            try:
+                bus = FrameBus(capacity, slots, bus_name)
+            except FileNotFoundError:
+                # replaced by a bigger bus before we got here
+                results.put((job_id, None))
+                continue
+        result = None
+        frame = bus.view(slot, seq)
+        if frame is not None:
+            try:
+                result = analyze(frame, *params)
+            except Exception as e:
+                log.error("%s failed: %s", factory, e)
+            # the frame changed under us, the result is not worth keeping
+            if not bus.valid(slot, seq):
+                result = None
+        results.put((job_id, result))
+        # no views may be left when the bus is closed
+        frame = result = None
+    if bus is not None:
+        bus.close()
+
+
+class Analyzer(object):
+    # one analyzer process fed from the frame bus, one job in flight at
+    # a time so it always works on a recent frame, same interface as
+    # faces.FaceWorker except submit takes a bus slot
+    min_interval = 0.0
+    # wait this many analyzer latencies between jobs, 1.0 keeps it busy
+    spacing = 1.0
+
+    def __init__(self, name, factory, args=(), robot=None):
+        self.name = name
+        self.robot = robot
+        self.jobs = mp.Queue()
+        self.results = mp.Queue()
+        self.proc = mp.Process(target=analyzer_main, name=name,
+                               args=(factory, args, self.jobs, self.results), daemon=True)
+        self.proc.start()
+        self.job_id = 0
+        self.future = None
+        self.submitted = 0.0
+        self.latency = None
+
+    def interval(self):
+        if self.latency is None:
+            return self.min_interval
+        return max(self.min_interval, self.latency * self.spacing)
+
+    def ready(self):
+        if self.future is not None:
+            return False
+        return time.monotonic() - self.submitted >= self.interval()
+
+    def submit(self, bus, slot, seq, params=(), context=None):
+        self.job_id += 1
+        bus.hold(slot)
+        self.future = (self.job_id, bus, slot, context)
+        self.submitted = time.monotonic()
+        self.jobs.put((self.job_id, bus.name, bus.capacity, bus.slots, slot, seq, tuple(params)))
+
+    def poll(self):
+        # the analyzer's result tuple with the context appended, once done
+        while self.future is not None:
+            try:
+                job_id, result = self.results.get_nowait()
+            except queue.Empty:
+                return None
+            if job_id != self.future[0]:
+                # left over from a cancelled job
+                continue
+            job_id, bus, slot, context = self.future
+            self.future = None
+            bus.release(slot)
+            dt = time.monotonic() - self.submitted
+            metrics.observe(self.name, dt, self.robot)
+            if self.latency is None:
+                self.latency = dt
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * dt
+            if result is None:
+                return None
+            return tuple(result) + (context,)
+        return None
+
+    def cancel(self):
+        # a job still running may read the slot after it is reused, it
+        # sees the new sequence number and returns nothing
+        if self.future is not None:
+            job_id, bus, slot, context = self.future
+            bus.release(slot)
+            self.future = None
+
+    def close(self):
+        self.cancel()
+        self.jobs.put(None)
+        self.proc.join(1.0)
+        if self.proc.is_alive():
+            self.proc.terminate()
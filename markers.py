@@ -0,0 +1,244 @@
+# markers.py
+# ArUco marker detection with cached detector objects and ROI tracking
+# and a tracker remembering markers and their poses over time
+
+import collections, heapq, threading, time
+import cv2
+import numpy as np
+import cv2.aruco as aruco
+
+
+class MarkerDetector(object):
+    # searches only around markers seen on the last frame, with a full
+    # frame rescan every rescan_interval frames or when a track is lost
+    rescan_interval = 15
+    # ROI padding as a fraction of the marker size
+    margin = 0.5
+
+    def __init__(self, dictionary=aruco.DICT_6X6_250):
+        # build these once, they are expensive to create per frame
+        self.aruco_dict = aruco.Dictionary_get(dictionary)
+        self.parameters = aruco.DetectorParameters_create()
+        self.parameters.adaptiveThreshConstant = 10
+        self.tracking = True
+        self.rois = {}
+        self.since_scan = 0
+
+    def detect_region(self, gray, x0=0, y0=0):
+        corners, ids, rejectedPts = aruco.detectMarkers(gray, self.aruco_dict, parameters=self.parameters)
+        if ids is None:
+            return [], []
+        if x0 or y0:
+            offset = np.array([x0, y0], dtype=np.float32)
+            corners = [c + offset for c in corners]
+        return list(corners), [int(i) for i in ids.reshape(-1)]
+
+    def roi_for(self, corner, shape):
+        h, w = shape[:2]
+        pts = corner.reshape(-1, 2)
+        x0, y0 = pts.min(axis=0)
+        x1, y1 = pts.max(axis=0)
+        pad = self.margin * max(x1 - x0, y1 - y0)
+        return (max(int(x0 - pad), 0), max(int(y0 - pad), 0),
+                min(int(x1 + pad) + 1, w), min(int(y1 + pad) + 1, h))
+
+    def detect(self, gray):
+        # returns (corners, ids) in the format of aruco.detectMarkers
+        full = not self.tracking or not self.rois or self.since_scan >= self.rescan_interval
+        if not full:
+            corners, ids = [], []
+            for x0, y0, x1, y1 in self.rois.values():
+                c, i = self.detect_region(gray[y0:y1, x0:x1], x0, y0)
+                for cc, ii in zip(c, i):
+                    if ii not in ids:
+                        corners.append(cc)
+                        ids.append(ii)
+            # a tracked marker went missing, look at the whole frame
+            if len(ids) < len(self.rois):
+                full = True
+        if full:
+            corners, ids = self.detect_region(gray)
+            self.since_scan = 0
+        else:
+            self.since_scan += 1
+
+        self.rois = {}
+        for c, i in zip(corners, ids):
+            self.rois[i] = self.roi_for(c, gray.shape)
+        if not ids:
+            return corners, None
+        return corners, np.array(ids, dtype=np.int32).reshape(-1, 1)
+
+    def reset(self):
+        self.rois = {}
+        self.since_scan = 0
+
+
+def find_markers(detector, img, mtx, dist, scale=1.0):
+    # returns (corners, ids, rvec, tvec) and the list of marker ids
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+    # lists of marker ids and corners of each
+    if scale < 1.0:
+        # detect on a smaller image, corners go back to full size
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        corners, ids = detector.detect(small)
+        corners = [c / scale for c in corners]
+    else:
+        corners, ids = detector.detect(gray)
+
+    ret_ids = []
+    rvec, tvec = None, None
+
+    # check if marker is detected
+    if np.all(ids != None):
+        # estimate pose of each marker
+        rvec, tvec, _ = aruco.estimatePoseSingleMarkers(corners, 0.05, mtx, dist)
+        ret_ids = [int(i) for i in ids.reshape(-1)]
+
+    return (corners, ids, rvec, tvec), ret_ids
+
+
+def analyzer(mtx, dist):
+    # frame bus analyzer, see framebus.Analyzer
+    detector = MarkerDetector()
+    last_scale = [None]
+
+    def analyze(rgb, scale):
+        if scale != last_scale[0]:
+            # ROIs are in the old detection resolution
+            detector.reset()
+            last_scale[0] = scale
+        return find_markers(detector, rgb, mtx, dist, scale)
+    return analyze
+
+
+class MarkerTrack(object):
+    # pose history of one marker
+    def __init__(self, marker_id, history, alpha):
+        self.id = marker_id
+        self.poses = collections.deque(maxlen=history)
+        self.alpha = alpha
+        self.smoothed = None
+        self.last_seen = 0.0
+        self.active = False
+        self.in_heap = False
+
+    def add(self, t, rvec, tvec):
+        self.poses.append((t, rvec, tvec))
+        self.last_seen = t
+        if self.smoothed is None:
+            self.smoothed = tvec.copy()
+        else:
+            self.smoothed += self.alpha * (tvec - self.smoothed)
+
+    def latest(self):
+        # (t, rvec, tvec) of the newest pose
+        return self.poses[-1] if self.poses else None
+
+    def velocity(self):
+        # translation per second over the pose history
+        if len(self.poses) < 2:
+            return np.zeros(3)
+        t0, r0, v0 = self.poses[0]
+        t1, r1, v1 = self.poses[-1]
+        if t1 <= t0:
+            return np.zeros(3)
+        return (v1 - v0) / (t1 - t0)
+
+
+class MarkerTracker(object):
+    # remembers markers over time and reports appear, return and
+    # disappear events, expiry is driven by a heap of deadlines so a
+    # frame only touches the markers it saw
+    timeout = 2.0
+    history = 30
+    # smoothing factor of the filtered position
+    alpha = 0.5
+
+    def __init__(self):
+        self.tracks = {}
+        self.heap = []
+        self.callbacks = []
+        # bumped after every update so consumers can wait for new poses
+        self.version = 0
+        self.cond = threading.Condition()
+
+    def add_callback(self, callback):
+        # callback(event, marker_id), event is appear, return or disappear
+        self.callbacks.append(callback)
+
+    def notify(self, event, marker_id):
+        for callback in self.callbacks:
+            callback(event, marker_id)
+
+    def update(self, ids, rvecs, tvecs, t=None):
+        if t is None:
+            t = time.monotonic()
+        # first retire markers gone longer than timeout, one seen again
+        # in this update then returns instead of carrying on silently
+        self.expire(t)
+        for i, marker_id in enumerate(ids):
+            track = self.tracks.get(marker_id)
+            if track is None:
+                track = self.tracks[marker_id] = MarkerTrack(marker_id, self.history, self.alpha)
+                self.notify('appear', marker_id)
+            elif not track.active:
+                self.notify('return', marker_id)
+            track.active = True
+            track.add(t, np.array(rvecs[i], dtype=np.float64).reshape(3),
+                      np.array(tvecs[i], dtype=np.float64).reshape(3))
+            if not track.in_heap:
+                heapq.heappush(self.heap, (t + self.timeout, marker_id))
+                track.in_heap = True
+        with self.cond:
+            self.version += 1
+            self.cond.notify_all()
+
+    def wait_update(self, version, timeout=None):
+        # blocks until there is an update newer than version, returns the new version
+        with self.cond:
+            if self.version == version:
+                self.cond.wait(timeout)
+            return self.version
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, marker_id = heapq.heappop(self.heap)
+            track = self.tracks[marker_id]
+            if track.last_seen + self.timeout > now:
+                # seen since it was scheduled, check again later
+                heapq.heappush(self.heap, (track.last_seen + self.timeout, marker_id))
+            else:
+                track.in_heap = False
+                track.active = False
+                self.notify('disappear', marker_id)
+
+    # Queries, cheap enough to call from other threads every frame
+
+    def active_ids(self):
+        return [i for i, track in list(self.tracks.items()) if track.active]
+
+    def latest(self, marker_id):
+        track = self.tracks.get(marker_id)
+        if track is None or not track.active:
+            return None
+        return track.latest()
+
+    def latest_poses(self):
+        # marker id -> (t, rvec, tvec) for every active marker
+        poses = {}
+        for i, track in list(self.tracks.items()):
+            if track.active:
+                poses[i] = track.latest()
+        return poses
+
+    def smoothed(self, marker_id):
+        track = self.tracks.get(marker_id)
+        return None if track is None else track.smoothed
+
+    def velocity(self, marker_id):
+        track = self.tracks.get(marker_id)
+        return None if track is None else track.velocity()
@@ -0,0 +1,151 @@
+# metrics.py
+# Timings and gauges for the video and control paths
+# exported as JSON lines or Prometheus text and shown in the GUI
+
+import collections, json, os, threading, time
+from contextlib import contextmanager
+
+
+class Timing(object):
+    # totals of observed durations plus a recent window for percentiles
+    def __init__(self, window=512):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        self.recent.append(seconds)
+
+    def percentiles(self, ps):
+        data = sorted(self.recent)
+        if not data:
+            return [0.0 for p in ps]
+        return [data[min(int(p * len(data)), len(data) - 1)] for p in ps]
+
+    def summary(self):
+        p50, p95, p99 = self.percentiles((0.5, 0.95, 0.99))
+        return {
+            'count': self.count,
+            'avg_ms': round(1000.0 * self.total / self.count, 3) if self.count else 0.0,
+            'last_ms': round(1000.0 * self.last, 3),
+            'p50_ms': round(1000.0 * p50, 3),
+            'p95_ms': round(1000.0 * p95, 3),
+            'p99_ms': round(1000.0 * p99, 3),
+        }
+
+
+class Registry(object):
+    # metrics are keyed by (robot, name), robot is None for the ones that
+    # are not tied to a robot, several robots report the same names
+    prefix = 'robo'
+
+    def __init__(self):
+        self.timings = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds, robot=None):
+        with self.lock:
+            t = self.timings.get((robot, name))
+            if t is None:
+                t = self.timings[(robot, name)] = Timing()
+            t.observe(seconds)
+
+    def gauge(self, name, value, robot=None):
+        self.gauges[(robot, name)] = value
+
+    @contextmanager
+    def timer(self, name, robot=None):
+        t = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - t, robot)
+
+    def snapshot(self):
+        # robot metrics go under robots, by robot name
+        with self.lock:
+            timings = dict((k, v.summary()) for k, v in self.timings.items())
+        snap = {'time': time.time(), 'timings': {}, 'gauges': {}, 'robots': {}}
+        for kind, values in (('timings', timings), ('gauges', dict(self.gauges))):
+            for (robot, name), value in values.items():
+                if robot is None:
+                    scope = snap
+                else:
+                    scope = snap['robots'].setdefault(robot, {'timings': {}, 'gauges': {}})
+                scope[kind][name] = value
+        return snap
+
+    def write_jsonl(self, path):
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.snapshot()) + '\n')
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            timings = dict((k, (v.percentiles((0.5, 0.95, 0.99)), v.total, v.count))
+                           for k, v in self.timings.items())
+        gauges = dict(self.gauges)
+        for name in sorted(set(name for robot, name in timings)):
+            metric = '%s_%s_seconds' % (self.prefix, name)
+            lines.append('# TYPE %s summary' % metric)
+            for robot in sorted(robot or '' for robot, n in timings if n == name):
+                qs, total, count = timings[(robot or None, name)]
+                for q, v in zip(('0.5', '0.95', '0.99'), qs):
+                    lines.append('%s%s %.6f' % (metric, labels(robot, quantile=q), v))
+                lines.append('%s_sum%s %.6f' % (metric, labels(robot), total))
+                lines.append('%s_count%s %d' % (metric, labels(robot), count))
+        for name in sorted(set(name for robot, name in gauges)):
+            metric = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s gauge' % metric)
+            for robot in sorted(robot or '' for robot, n in gauges if n == name):
+                lines.append('%s%s %s' % (metric, labels(robot), gauges[(robot or None, name)]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # replace the file whole so a scraper never reads half of it
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def overlay_text(self, names=None, robot=None):
+        # short summary for the GUI overlay, the shared metrics plus robot's
+        snap = self.snapshot()
+        timings = dict(snap['timings'])
+        gauges = dict(snap['gauges'])
+        if robot in snap['robots']:
+            timings.update(snap['robots'][robot]['timings'])
+            gauges.update(snap['robots'][robot]['gauges'])
+        lines = []
+        for name in names or sorted(timings):
+            t = timings.get(name)
+            if t is not None:
+                lines.append('%-14s %7.1f ms  p95 %7.1f' % (name, t['avg_ms'], t['p95_ms']))
+        for name in sorted(gauges):
+            lines.append('%-14s %7s' % (name, gauges[name]))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.gauges = {}
+
+
+def labels(robot, **extra):
+    # Prometheus label set, robot is '' for shared metrics
+    pairs = ([('robot', robot)] if robot else []) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+REGISTRY = Registry()
+observe = REGISTRY.observe
+gauge = REGISTRY.gauge
+timer = REGISTRY.timer
@@ -0,0 +1,117 @@
+# mjpeg.py
+# Reads the mjpg-streamer multipart stream without decoding it
+
+import logging, re, socket
+import urllib.request
+
+log = logging.getLogger(__name__)
+
+
+def jpeg_size(buf):
+    # (width, height) from the SOF header of a JPEG, None if not found
+    i = 2
+    n = len(buf)
+    while i + 9 < n:
+        if buf[i] != 0xff:
+            i += 1
+            continue
+        marker = buf[i + 1]
+        if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7 or marker == 0xff:
+            i += 1 if marker == 0xff else 2
+            continue
+        length = (buf[i + 2] << 8) | buf[i + 3]
+        # SOF0..SOF15 except DHT, JPG and DAC
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            h = (buf[i + 5] << 8) | buf[i + 6]
+            w = (buf[i + 7] << 8) | buf[i + 8]
+            return w, h
+        i += 2 + length
+    return None
+
+
+class MjpegReader(object):
+    # parses multipart boundaries itself and returns the raw JPEG bytes
+    # of each frame, so frames can be saved without a decode/encode
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.resp = None
+        self.boundary = None
+
+    def open(self, url):
+        try:
+            self.resp = urllib.request.urlopen(url, timeout=self.timeout)
+        except (OSError, ValueError) as e:
+            log.error("Could not open stream: %s", e)
+            return False
+        ctype = self.resp.headers.get('Content-Type', '')
+        m = re.search(r'boundary="?([^";]+)"?', ctype)
+        if 'multipart' not in ctype or m is None:
+            log.error("Not an MJPEG stream: %s", ctype)
+            self.release()
+            return False
+        boundary = m.group(1).strip()
+        if boundary.startswith('--'):
+            boundary = boundary[2:]
+        self.boundary = b'--' + boundary.encode('latin-1')
+        return True
+
+    def isOpened(self):
+        return self.resp is not None
+
+    def read_jpeg(self):
+        # next frame's JPEG bytes, None when the stream ends or fails
+        if self.resp is None:
+            return None
+        try:
+            # skip to the next boundary
+            while True:
+                line = self.resp.readline()
+                if not line:
+                    return None
+                if line.strip().startswith(self.boundary):
+                    break
+            # part headers
+            length = None
+            while True:
+                line = self.resp.readline()
+                if not line:
+                    return None
+                line = line.strip()
+                if not line:
+                    break
+                key, _, value = line.partition(b':')
+                if key.strip().lower() == b'content-length':
+                    length = int(value)
+            if length is not None:
+                data = self.resp.read(length)
+                if len(data) != length:
+                    return None
+                return data
+            # no length given, read up to the JPEG end marker
+            data = bytearray()
+            while True:
+                line = self.resp.readline()
+                if not line:
+                    return None
+                data += line
+                if data.rstrip(b'\r\n').endswith(b'\xff\xd9'):
+                    return bytes(data.rstrip(b'\r\n'))
+        except (OSError, ValueError) as e:
+            log.error("Stream read failed: %s", e)
+            return None
+
+    def interrupt(self):
+        # wakes a read blocked on the stream from another thread, the
+        # read then fails and the owner releases the reader
+        resp = self.resp
+        sock = getattr(getattr(getattr(resp, 'fp', None), 'raw', None), '_sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def release(self):
+        if self.resp is not None:
+            self.resp.close()
+            self.resp = None
@@ -0,0 +1,143 @@
+# pipeline.py
+# Bounded queues and worker stages for the video pipeline
+
+import logging, threading, time, collections
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class Meter(object):
+    # counts events and keeps a rate averaged over a short window
+    def __init__(self, window=1.0):
+        self.window = window
+        self.count = 0
+        self.fps = 0.0
+        self._n = 0
+        self._t = time.monotonic()
+
+    def tick(self, n=1):
+        self.count += n
+        self._n += n
+        now = time.monotonic()
+        dt = now - self._t
+        if dt >= self.window:
+            self.fps = self._n / dt
+            self._n = 0
+            self._t = now
+
+
+class FrameQueue(object):
+    # bounded queue, when full the oldest item is dropped so the
+    # consumer always gets the newest frame
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+    def clear(self):
+        with self.cond:
+            self.items.clear()
+
+
+class Packet(object):
+    # one frame travelling through the pipeline
+    def __init__(self, seq, frame):
+        self.seq = seq
+        self.t_capture = time.monotonic()
+        self.frame = frame
+        # compressed frame as it came off the stream, if known
+        self.jpeg = None
+        self.rgb = None
+        self.markers = None
+        self.faces = []
+        # frame bus slot holding rgb, once written
+        self.slot = None
+
+
+class Stage(threading.Thread):
+    # runs func on every item of in_q and puts the result on out_q
+    # a stage without in_q is a source and calls func() in a loop
+    # func returning None drops the item, so does func raising, the
+    # stage logs it and carries on with the next item
+    error_log_interval = 5.0
+
+    def __init__(self, name, func, in_q=None, out_q=None, robot=None):
+        super(Stage, self).__init__(name=name, daemon=True)
+        # metrics label of the robot the pipeline belongs to
+        self.robot = robot
+        self.func = func
+        self.in_q = in_q
+        self.out_q = out_q
+        self.running = True
+        self.meter = Meter()
+        self.busy = 0.0
+        self.errors = 0
+        self.error_t = None
+
+    def call(self, *args):
+        try:
+            return self.func(*args)
+        except Exception:
+            self.errors += 1
+            now = time.monotonic()
+            # a func failing on every frame should not flood the log
+            if self.error_t is None or now - self.error_t >= self.error_log_interval:
+                self.error_t = now
+                log.exception("Stage %s failed (%d errors so far)", self.name, self.errors)
+            return None
+
+    def run(self):
+        while self.running:
+            if self.in_q is None:
+                t = time.monotonic()
+                item = self.call()
+            else:
+                item = self.in_q.get(0.1)
+                if item is None:
+                    continue
+                t = time.monotonic()
+                item = self.call(item)
+            if item is None:
+                if self.in_q is None:
+                    time.sleep(0.005)
+                continue
+            dt = time.monotonic() - t
+            self.busy += dt
+            metrics.observe(self.name, dt, self.robot)
+            self.meter.tick()
+            if self.out_q is not None:
+                self.out_q.put(item)
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        count = self.meter.count
+        return {
+            'fps': round(self.meter.fps, 1),
+            'frames': count,
+            'avg_ms': round(1000.0 * self.busy / count, 2) if count else 0.0,
+            'dropped': self.in_q.dropped if self.in_q is not None else 0,
+            'errors': self.errors,
+        }
@@ -0,0 +1,109 @@
+# quality.py
+# Lowers analysis resolution and rate when the pipeline cannot keep up
+
+import logging, threading, time
+import urllib.request
+
+log = logging.getLogger(__name__)
+
+
+class QualityController(object):
+    # (resolution multiplier, analyse every nth frame), best first
+    LEVELS = [(1.0, 1), (0.75, 1), (0.75, 2), (0.5, 2), (0.5, 3), (0.5, 4)]
+    # detection resolution at the best level, relative to the stream
+    face_scale_base = 0.5
+    aruco_scale_base = 1.0
+    # step down above the frame budget, step up below this fraction of it
+    low_water = 0.5
+    # seconds between level changes
+    settle_time = 1.0
+    # optional url asking the camera for another mode, formatted with
+    # width, height and fps, e.g. a firmware hook next to mjpg-streamer
+    stream_control_url = None
+
+    def __init__(self, fps=30.0):
+        self.level = 0
+        self.budget = 1.0 / fps
+        self.avg = None
+        self.frame_n = 0
+        self.last_change = time.monotonic()
+        self.stream_mode = None
+        self.base_mode = None
+
+    @property
+    def face_scale(self):
+        return self.face_scale_base * self.LEVELS[self.level][0]
+
+    @property
+    def aruco_scale(self):
+        return self.aruco_scale_base * self.LEVELS[self.level][0]
+
+    @property
+    def every(self):
+        return self.LEVELS[self.level][1]
+
+    def set_fps(self, fps):
+        if fps >= 1:
+            self.budget = 1.0 / fps
+
+    def should_analyze(self):
+        self.frame_n += 1
+        return self.frame_n % self.every == 0
+
+    def observe(self, seconds):
+        # analysis time of one frame, returns True if the level changed
+        # time is spread over the frames that were skipped
+        cost = seconds / self.every
+        self.avg = cost if self.avg is None else 0.9 * self.avg + 0.1 * cost
+        now = time.monotonic()
+        if now - self.last_change < self.settle_time:
+            return False
+        if self.avg > self.budget and self.level < len(self.LEVELS) - 1:
+            self.set_level(self.level + 1, now)
+            return True
+        if self.avg > self.budget:
+            self.request_lower_stream()
+        elif self.avg < self.budget * self.low_water and self.level > 0:
+            # the cost per frame goes up again when we step back
+            self.set_level(self.level - 1, now)
+            return True
+        elif self.level == 0 and self.stream_mode is not None:
+            self.request_stream(*self.base_mode)
+            self.stream_mode = None
+        return False
+
+    def set_level(self, level, now):
+        log.info("Analysis quality level %d -> %d (%.1f ms per frame, budget %.1f ms)",
+                 self.level, level, 1000.0 * self.avg, 1000.0 * self.budget)
+        self.level = level
+        self.last_change = now
+        self.avg = None
+
+    def set_stream_mode(self, width, height, fps):
+        # what the camera streams when not under load
+        self.base_mode = (width, height, fps)
+
+    def request_lower_stream(self):
+        if self.stream_control_url is None or self.base_mode is None or self.stream_mode is not None:
+            return
+        w, h, fps = self.base_mode
+        self.stream_mode = (w // 2, h // 2, max(fps // 2, 5))
+        self.request_stream(*self.stream_mode)
+
+    def request_stream(self, width, height, fps):
+        if self.stream_control_url is None:
+            return
+        url = self.stream_control_url.format(width=width, height=height, fps=fps)
+
+        def send():
+            try:
+                urllib.request.urlopen(url, timeout=2.0).close()
+                log.info("Requested stream mode %dx%d @ %s fps", width, height, fps)
+            except (OSError, ValueError) as e:
+                log.warning("Stream mode request failed: %s", e)
+        threading.Thread(target=send, name='stream-mode', daemon=True).start()
+
+
+def scale_box(box, inv):
+    # (top, right, bottom, left) from detection back to display coordinates
+    return tuple(int(round(v * inv)) for v in box)
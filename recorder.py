@@ -0,0 +1,215 @@
+# recorder.py
+# Writes video on its own thread so recording never slows the feed
+
+import threading, collections, logging, struct
+import cv2
+import numpy as np
+import pipeline
+from mjpeg import jpeg_size
+
+log = logging.getLogger(__name__)
+
+
+class PreRoll(object):
+    # the last few seconds of compressed frames, flushed into a new
+    # recording so it starts before the button was pressed
+    def __init__(self, seconds=5.0, max_bytes=64 << 20):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.frames = collections.deque()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, t, jpeg):
+        with self.lock:
+            self.frames.append((t, jpeg))
+            self.nbytes += len(jpeg)
+            while self.frames and (t - self.frames[0][0] > self.seconds or self.nbytes > self.max_bytes):
+                self.nbytes -= len(self.frames.popleft()[1])
+
+    def take(self):
+        # empties the buffer and returns its (t, jpeg) frames, oldest first
+        with self.lock:
+            frames = list(self.frames)
+            self.frames.clear()
+            self.nbytes = 0
+        return frames
+
+    def stats(self):
+        with self.lock:
+            span = self.frames[-1][0] - self.frames[0][0] if self.frames else 0.0
+            return {'frames': len(self.frames), 'bytes': self.nbytes, 'seconds': round(span, 2)}
+
+
+class AviWriter(object):
+    # minimal Motion-JPEG AVI writer, JPEG frames are stored as given
+    # so recording from an MJPEG stream needs no decode or re-encode
+    def __init__(self, path, size, fps):
+        self.f = open(path, 'wb')
+        self.size = size
+        self.fps = fps
+        self.index = []
+        self.write_header()
+
+    def isOpened(self):
+        return self.f is not None
+
+    def write_header(self):
+        w, h = self.size
+        f = self.f
+        avih = struct.pack('<14I', int(1e6 / self.fps), 0, 0, 0x10, 0, 0, 1, 0, w, h, 0, 0, 0, 0)
+        strh = struct.pack('<4s4sIHHIIIIIIIIhhhh', b'vids', b'MJPG', 0, 0, 0, 0,
+                           1000, int(round(self.fps * 1000)), 0, 0, 0, 0xffffffff, 0, 0, 0, w, h)
+        strf = struct.pack('<IiiHH4sIiiII', 40, w, h, 1, 24, b'MJPG', w * h * 3, 0, 0, 0, 0)
+        strl = b'strl' + b'strh' + struct.pack('<I', len(strh)) + strh + \
+               b'strf' + struct.pack('<I', len(strf)) + strf
+        f.write(b'RIFF' + struct.pack('<I', 0) + b'AVI ')
+        f.write(b'LIST' + struct.pack('<I', 4 + 8 + len(avih) + 8 + len(strl)) + b'hdrl')
+        f.write(b'avih' + struct.pack('<I', len(avih)))
+        self.avih_pos = f.tell()
+        f.write(avih)
+        f.write(b'LIST' + struct.pack('<I', len(strl)))
+        self.strh_pos = f.tell() + 12
+        f.write(strl)
+        self.movi_pos = f.tell()
+        f.write(b'LIST' + struct.pack('<I', 0) + b'movi')
+
+    def write(self, jpeg):
+        f = self.f
+        self.index.append((f.tell() - self.movi_pos - 8, len(jpeg)))
+        f.write(b'00dc' + struct.pack('<I', len(jpeg)))
+        f.write(jpeg)
+        if len(jpeg) & 1:
+            f.write(b'\0')
+
+    def release(self):
+        if self.f is None:
+            return
+        f = self.f
+        movi_end = f.tell()
+        f.write(b'idx1' + struct.pack('<I', 16 * len(self.index)))
+        for off, n in self.index:
+            f.write(struct.pack('<4sIII', b'00dc', 0x10, off, n))
+        end = f.tell()
+        # patch the sizes and frame counts now that they are known
+        f.seek(4)
+        f.write(struct.pack('<I', end - 8))
+        f.seek(self.movi_pos + 4)
+        f.write(struct.pack('<I', movi_end - self.movi_pos - 8))
+        f.seek(self.avih_pos + 16)
+        f.write(struct.pack('<I', len(self.index)))
+        f.seek(self.strh_pos + 32)
+        f.write(struct.pack('<I', len(self.index)))
+        f.close()
+        self.f = None
+
+
+class Recorder(threading.Thread):
+    # codec name -> (fourcc, container)
+    CODECS = {
+        'mjpg': ('MJPG', '.avi'),
+        'xvid': ('XVID', '.avi'),
+        'mp4v': ('mp4v', '.mp4'),
+        'h264': ('avc1', '.mp4'),
+    }
+
+    def __init__(self, name, fps=20.0, codec='mjpg', buffer_size=64, passthrough=True):
+        super(Recorder, self).__init__(name='recorder', daemon=True)
+        fourcc, ext = self.CODECS[codec]
+        self.path = name + ext
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        # MJPG files take the stream's JPEG bytes as they are
+        self.passthrough = passthrough and codec == 'mjpg'
+        # ring buffer between the capture stage and the writer
+        self.queue = pipeline.FrameQueue(buffer_size)
+        self.running = True
+        self.out = None
+        self.failed = False
+        self.t0 = None
+        self.preroll = []
+        self.preroll_frames = 0
+        self.written = 0
+        self.duplicated = 0
+        self.skipped = 0
+
+    def write(self, t, frame=None, jpeg=None):
+        # t is the capture time, give the decoded frame, the JPEG or both
+        self.queue.put((t, frame, jpeg))
+
+    def preload(self, frames):
+        # (t, jpeg) frames written ahead of everything else, call before start
+        self.preroll = frames
+        self.preroll_frames = len(frames)
+
+    def open_writer(self, data):
+        if self.passthrough:
+            size = jpeg_size(data)
+            if size is None:
+                return None
+            return AviWriter(self.path, size, self.fps)
+        h, w = data.shape[:2]
+        return cv2.VideoWriter(self.path, self.fourcc, self.fps, (w, h))
+
+    def write_timed(self, t, frame, jpeg):
+        # the file has a constant frame rate, so repeat or skip frames
+        # to keep playback in step with the capture timestamps
+        if self.failed:
+            return
+        if self.t0 is None:
+            self.t0 = t
+        target = int(round((t - self.t0) * self.fps))
+        if target < self.written:
+            self.skipped += 1
+            return
+        if self.passthrough:
+            if jpeg is None:
+                ok, buf = cv2.imencode('.jpg', frame)
+                jpeg = buf.tobytes() if ok else None
+            data = jpeg
+        else:
+            if frame is None:
+                frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            data = frame
+        if data is None:
+            return
+        if self.out is None:
+            self.out = self.open_writer(data)
+            if self.out is None or not self.out.isOpened():
+                log.error("Could not open video writer for %s", self.path)
+                self.failed = True
+                return
+        while self.written <= target:
+            self.out.write(data)
+            if self.written < target:
+                self.duplicated += 1
+            self.written += 1
+
+    def run(self):
+        for t, jpeg in self.preroll:
+            self.write_timed(t, None, jpeg)
+        self.preroll = []
+        while self.running or len(self.queue):
+            item = self.queue.get(0.1)
+            if item is None:
+                continue
+            self.write_timed(*item)
+        if self.out is not None:
+            self.out.release()
+        log.info("Done Recording %s", self.stats())
+
+    def stop(self, wait=True):
+        # the writer drains what is buffered before closing the file
+        self.running = False
+        if wait:
+            self.join()
+
+    def stats(self):
+        return {
+            'file': self.path,
+            'preroll': self.preroll_frames,
+            'written': self.written,
+            'dropped': self.queue.dropped,
+            'duplicated': self.duplicated,
+            'skipped': self.skipped,
+        }
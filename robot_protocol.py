@@ -0,0 +1,72 @@
+# robot_protocol.py
+# Binary command frames understood by the robot
+# every frame is 5 bytes: ff <group> <channel> <value> ff
+
+import struct
+
+
+class RobotProtocol(object):
+    HEAD = 0xff
+    TAIL = 0xff
+    FRAME_LEN = 5
+    # groups and channels
+    DRIVE = 0x00
+    SERVO = 0x01
+    MOTOR = 0x02
+    LED = 0x04
+    SERVO_HORZ = 0x07
+    SERVO_VERT = 0x08
+    MOTOR_LEFT = 0x01
+    MOTOR_RIGHT = 0x02
+    SERVO_MAX = 180
+    SPEED_MAX = 100
+
+    _frame = struct.Struct('5B')
+
+    @classmethod
+    def build(cls, group, channel, value=0):
+        return cls._frame.pack(cls.HEAD, group, channel, value, cls.TAIL)
+
+    @classmethod
+    def parse(cls, text):
+        # validate a hex command typed by the user, raises ValueError
+        try:
+            frame = bytes.fromhex(text)
+        except ValueError:
+            raise ValueError("command is not hex: %r" % text)
+        if len(frame) != cls.FRAME_LEN:
+            raise ValueError("command must be %d bytes, got %d" % (cls.FRAME_LEN, len(frame)))
+        if frame[0] != cls.HEAD or frame[-1] != cls.TAIL:
+            raise ValueError("command must start and end with ff")
+        return frame
+
+    @classmethod
+    def horz(cls, value):
+        return cls.HORZ_TABLE[value]
+
+    @classmethod
+    def vert(cls, value):
+        return cls.VERT_TABLE[value]
+
+    @classmethod
+    def speed(cls, value):
+        # (left, right) motor frames
+        return cls.SPEED_TABLE[value]
+
+
+# fixed frames
+RobotProtocol.STOP = RobotProtocol.build(RobotProtocol.DRIVE, 0x00)
+RobotProtocol.FORWARD = RobotProtocol.build(RobotProtocol.DRIVE, 0x01)
+RobotProtocol.BACKWARD = RobotProtocol.build(RobotProtocol.DRIVE, 0x02)
+RobotProtocol.RIGHT = RobotProtocol.build(RobotProtocol.DRIVE, 0x03)
+RobotProtocol.LEFT = RobotProtocol.build(RobotProtocol.DRIVE, 0x04)
+RobotProtocol.LED_ON = RobotProtocol.build(RobotProtocol.LED, 0x00)
+RobotProtocol.LED_OFF = RobotProtocol.build(RobotProtocol.LED, 0x01)
+# parameterized frames are built once so teleop only does a lookup
+RobotProtocol.HORZ_TABLE = tuple(RobotProtocol.build(RobotProtocol.SERVO, RobotProtocol.SERVO_HORZ, v)
+                                 for v in range(RobotProtocol.SERVO_MAX + 1))
+RobotProtocol.VERT_TABLE = tuple(RobotProtocol.build(RobotProtocol.SERVO, RobotProtocol.SERVO_VERT, v)
+                                 for v in range(RobotProtocol.SERVO_MAX + 1))
+RobotProtocol.SPEED_TABLE = tuple((RobotProtocol.build(RobotProtocol.MOTOR, RobotProtocol.MOTOR_LEFT, v),
+                                   RobotProtocol.build(RobotProtocol.MOTOR, RobotProtocol.MOTOR_RIGHT, v))
+                                  for v in range(RobotProtocol.SPEED_MAX + 1))
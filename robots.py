@@ -0,0 +1,143 @@
+# robots.py
+# Connections and video pipeline of one robot, so the controller can
+# drive several robots from one window
+
+import socket, logging
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+import video_controller as vcon
+import vision_client
+import transport
+import supervisor
+import follow
+
+log = logging.getLogger(__name__)
+
+
+class RobotLink(QObject):
+    changePixmap = pyqtSignal(QImage)
+    videoReady = pyqtSignal(bool)
+    stateChanged = pyqtSignal(str)
+
+    def __init__(self, name, ctrl_address, stream_url, parent=None, engine_address=None):
+        super(RobotLink, self).__init__(parent)
+        self.name = name
+        self.ctrl_address = ctrl_address
+        self.stream_url = stream_url
+        # (host, port) of a vision_server running the engine, None runs it here
+        self.engine_address = engine_address
+        # Connections
+        self.th = None
+        self.ctrl_con = None
+        self.ctrl_sender = None
+        self.is_con_status = False
+        # Modes, carried over to every new video thread
+        self.is_face_recog_on = False
+        self.is_ar_on = False
+        self.is_recording_vid = False
+        self.display_size = (640, 480)
+        self.display_enabled = True
+        # share the face worker processes between robots
+        self.share_workers = False
+        # marker following, None when off
+        self.follower = None
+        # sessionlog.SessionLog of what was sent, None when not logging
+        self.session_log = None
+        self.supervisor = supervisor.ConnectionSupervisor(self)
+        self.supervisor.stateChanged.connect(self.stateChanged)
+
+    def start(self):
+        self.supervisor.start()
+
+    def restart(self):
+        self.supervisor.restart()
+
+    def shutdown(self):
+        self.stopFollow()
+        self.supervisor.shutdown()
+        if self.session_log is not None:
+            self.session_log.close()
+
+    def closeControl(self):
+        self.is_con_status = False
+        if self.ctrl_sender is not None:
+            self.ctrl_sender.close()
+            self.ctrl_sender = None
+        if self.ctrl_con is not None:
+            self.ctrl_con.close()
+            self.ctrl_con = None
+
+    def controlAlive(self):
+        return self.is_con_status and self.ctrl_sender is not None and self.ctrl_sender.is_alive()
+
+    def initializeControl(self):
+        # create socket
+        self.ctrl_con = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.ctrl_con.settimeout(0.1)
+        # bind sock to port
+        try:
+            self.ctrl_con.connect(self.ctrl_address)
+            # send from a background thread so the GUI never blocks
+            self.ctrl_sender = transport.CommandSender(self.ctrl_con, self.name)
+            self.ctrl_sender.start()
+            self.is_con_status = True
+        except Exception as e:
+            log.error("%s: could not connect to control socket: %s", self.name, e)
+            self.closeControl()
+        return self.is_con_status
+
+    def initializeVideo(self):
+        if self.engine_address is not None:
+            self.th = vision_client.RemoteVThread(self.engine_address)
+        else:
+            self.th = vcon.VThread()
+            self.th.stream_url = self.stream_url
+            if self.th.stream_control_url is not None:
+                # one template for every robot
+                self.th.stream_control_url = self.th.stream_control_url.replace('{host}', self.ctrl_address[0])
+        self.th.robot_name = self.name
+        self.th.display_size = self.display_size
+        self.th.display_enabled = self.display_enabled
+        self.th.share_workers = self.share_workers
+        # carry the current modes over to the new thread
+        self.th.do_face_recog = self.is_face_recog_on
+        self.th.do_aruco = self.is_ar_on
+        self.th.should_record_video = self.is_recording_vid
+        self.th.session_log = self.session_log
+        self.th.changePixmap.connect(self.changePixmap)
+        self.th.videoReady.connect(self.videoReady)
+        self.th.start()
+
+    def frame_shown(self):
+        if self.th is not None:
+            self.th.frame_shown()
+
+    def setDisplay(self, size, enabled=True):
+        # hidden robots keep running but stop sending frames to the GUI
+        self.display_size = size
+        self.display_enabled = enabled
+        if self.th is not None:
+            self.th.display_size = size
+            self.th.display_enabled = enabled
+
+    def follow(self, marker_id, horz, vert, center_horz):
+        # the follower needs marker poses, so AR mode goes on with it
+        self.stopFollow()
+        self.is_ar_on = True
+        if self.th is not None:
+            self.th.do_aruco = True
+        self.follower = follow.MarkerFollower(self, marker_id, horz, vert, center_horz)
+        self.follower.start()
+
+    def stopFollow(self):
+        if self.follower is not None:
+            self.follower.stop()
+            self.follower = None
+
+    def run_cmd(self, cmd):
+        # cmd is a frame from RobotProtocol, frames dropped while the link
+        # is down stay out of the session log so a replay matches the robot
+        if self.controlAlive():
+            self.ctrl_sender.send( cmd )
+            if self.session_log is not None:
+                self.session_log.command(cmd)
@@ -0,0 +1,97 @@
+# screenshots.py
+# Saves screenshots on a thread pool so the video never waits on encoding
+
+import concurrent.futures
+import logging, os, threading, time
+import cv2
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class ScreenshotService(object):
+    # fmt is 'jpg' (fast) or 'png' (lossless)
+    # burst_rate 0 takes one shot per button press, otherwise shots are
+    # taken at that rate for as long as the button is held
+    def __init__(self, folder='Screenshots', fmt='jpg', quality=90, burst_rate=0.0,
+                 workers=2, max_pending=8, robot=None):
+        self.folder = folder
+        self.robot = robot
+        self.fmt = fmt
+        self.quality = quality
+        self.burst_rate = burst_rate
+        self.max_pending = max_pending
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                          thread_name_prefix='screenshot')
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.seq = 0
+        self.saved = 0
+        self.dropped = 0
+        # button -> time of the last shot while it is held
+        self.held = {}
+
+    def due(self, key, held, now=None):
+        # True when the button named key should take a shot this frame
+        if not held:
+            self.held.pop(key, None)
+            return False
+        if now is None:
+            now = time.monotonic()
+        last = self.held.get(key)
+        if last is None or (self.burst_rate > 0 and now - last >= 1.0 / self.burst_rate):
+            self.held[key] = now
+            return True
+        return False
+
+    def filename(self, ext):
+        now = time.time()
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime(now))
+        return os.path.join(self.folder, 'pic_%s_%03d_%04d.%s' % (stamp, int(now * 1000) % 1000, seq, ext))
+
+    def capture(self, image, rgb=False, jpeg=None):
+        # image must not be changed afterwards, the pipeline makes a new
+        # one per frame so it is handed over without a copy
+        # jpeg is the stream's own frame, saved as it is in jpg mode
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.dropped += 1
+                return None
+            self.pending += 1
+        ext = 'png' if self.fmt == 'png' else 'jpg'
+        path = self.filename(ext)
+        self.pool.submit(self.save, path, image, rgb, jpeg if ext == 'jpg' else None)
+        return path
+
+    def save(self, path, image, rgb, jpeg):
+        t = time.monotonic()
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            if jpeg is not None:
+                with open(path, 'wb') as f:
+                    f.write(jpeg)
+            else:
+                if rgb:
+                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+                if path.endswith('.png'):
+                    params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+                else:
+                    params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+                if not cv2.imwrite(path, image, params):
+                    raise IOError("imwrite failed")
+            self.saved += 1
+            log.debug("Saved screenshot %s", path)
+        except Exception as e:
+            log.error("Could not save screenshot %s: %s", path, e)
+        finally:
+            with self.lock:
+                self.pending -= 1
+            metrics.observe('screenshot', time.monotonic() - t, self.robot)
+
+    def close(self):
+        # pending shots are still written
+        self.pool.shutdown(wait=False)
+        log.info("Screenshots: %d saved, %d dropped", self.saved, self.dropped)
@@ -0,0 +1,174 @@
+# sessionlog.py
+# Append-only binary log of a driving session: command frames, marker
+# events, face matches and where recorded videos start, so a session can
+# be lined up with its video and replayed
+#
+# file:   b'RLOG' <version:H> <wall clock start:d> then records
+# record: <t:d, seconds from start> <kind:B> <length:H> <payload>
+# index:  path + '.idx', (t, file offset) pairs every index_interval seconds
+
+import bisect, collections, logging, os, struct, threading, time
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'RLOG'
+VERSION = 1
+# record kinds
+CMD = 1       # the 5 byte command frame
+MARKER = 2    # <event:B> <marker id:i>
+FACE = 3      # <distance:f> name, utf-8, distance is -1 when unknown
+VIDEO = 4     # <video start t:d> <fps:d> path, utf-8
+MARKER_EVENTS = ('appear', 'return', 'disappear')
+
+_file_head = struct.Struct('<4sHd')
+_record = struct.Struct('<dBH')
+_index = struct.Struct('<dQ')
+_marker = struct.Struct('<Bi')
+_face = struct.Struct('<f')
+_video = struct.Struct('<dd')
+
+
+class SessionLog(threading.Thread):
+    # callers only append to a queue, the file is written on this thread
+    flush_interval = 1.0
+    index_interval = 1.0
+
+    def __init__(self, path):
+        super(SessionLog, self).__init__(name='session-log', daemon=True)
+        self.path = path
+        # times are monotonic, like the capture times of the video pipeline
+        self.t0 = time.monotonic()
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.records = 0
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.f = open(path, 'wb', buffering=1 << 16)
+        self.idx = open(path + '.idx', 'wb', buffering=1 << 12)
+        self.f.write(_file_head.pack(MAGIC, VERSION, time.time()))
+        self.start()
+
+    def add(self, kind, payload, t=None):
+        if t is None:
+            t = time.monotonic()
+        with self.cond:
+            self.items.append((t - self.t0, kind, payload))
+            self.cond.notify()
+
+    def command(self, frame, t=None):
+        self.add(CMD, bytes(frame), t)
+
+    def marker(self, event, marker_id, t=None):
+        self.add(MARKER, _marker.pack(MARKER_EVENTS.index(event), marker_id), t)
+
+    def face(self, name, dist, t=None):
+        self.add(FACE, _face.pack(-1.0 if dist is None else dist) + name.encode(), t)
+
+    def video(self, path, t_start, fps, t=None):
+        # a recording whose frame n was captured at t_start + n / fps
+        self.add(VIDEO, _video.pack(t_start - self.t0, fps) + path.encode(), t)
+
+    def run(self):
+        last_flush = time.monotonic()
+        last_index = None
+        while True:
+            with self.cond:
+                if not self.items and self.running:
+                    self.cond.wait(self.flush_interval)
+                items = list(self.items)
+                self.items.clear()
+                running = self.running
+            for t, kind, payload in items:
+                if last_index is None or t - last_index >= self.index_interval:
+                    self.idx.write(_index.pack(t, self.f.tell()))
+                    last_index = t
+                self.f.write(_record.pack(t, kind, len(payload)))
+                self.f.write(payload)
+                self.records += 1
+            now = time.monotonic()
+            if now - last_flush >= self.flush_interval:
+                self.f.flush()
+                self.idx.flush()
+                last_flush = now
+            if not running and not self.items:
+                break
+        self.f.close()
+        self.idx.close()
+        log.info("Session log %s: %d records", self.path, self.records)
+
+    def close(self, wait=True):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if wait:
+            self.join()
+
+
+class SessionReader(object):
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        magic, version, self.wall_start = _file_head.unpack(self.f.read(_file_head.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a session log" % path)
+        self.index = []
+        try:
+            with open(path + '.idx', 'rb') as f:
+                data = f.read()
+            n = len(data) // _index.size
+            self.index = [_index.unpack_from(data, i * _index.size) for i in range(n)]
+        except OSError:
+            log.warning("No index for %s, seeking will scan", path)
+        self.index_t = [t for t, off in self.index]
+
+    def seek(self, t):
+        # file offset of the last indexed record at or before t
+        i = bisect.bisect_right(self.index_t, t) - 1
+        return self.index[i][1] if i >= 0 else _file_head.size
+
+    def records(self, start=0.0):
+        # yields (t, kind, payload) from time start on
+        self.f.seek(self.seek(start))
+        while True:
+            head = self.f.read(_record.size)
+            if len(head) < _record.size:
+                return
+            t, kind, n = _record.unpack(head)
+            payload = self.f.read(n)
+            if len(payload) < n:
+                # the writer was stopped mid record
+                return
+            if t >= start:
+                yield t, kind, payload
+
+    def videos(self):
+        # every recording in the log as (path, start t, fps)
+        return [decode(kind, payload) for t, kind, payload in self.records() if kind == VIDEO]
+
+    def close(self):
+        self.f.close()
+
+
+def decode(kind, payload):
+    if kind == CMD:
+        return payload
+    if kind == MARKER:
+        event, marker_id = _marker.unpack(payload)
+        return MARKER_EVENTS[event], marker_id
+    if kind == FACE:
+        dist, = _face.unpack_from(payload)
+        return payload[_face.size:].decode(), None if dist < 0 else dist
+    if kind == VIDEO:
+        t_start, fps = _video.unpack_from(payload)
+        return payload[_video.size:].decode(), t_start, fps
+    return payload
+
+
+def video_frame(videos, t):
+    # (path, frame number) in the last recording started before t, or None
+    for path, t_start, fps in reversed(videos):
+        if t >= t_start:
+            return path, int(round((t - t_start) * fps))
+    return None
@@ -0,0 +1,166 @@
+# supervisor.py
+# Keeps the video stream and control link alive, reconnecting with backoff
+
+import logging, time
+from PyQt5.QtCore import *
+
+log = logging.getLogger(__name__)
+
+
+class Backoff(object):
+    # exponential delay between reconnect attempts
+    def __init__(self, start=0.5, maximum=10.0, factor=2.0):
+        self.start = start
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = start
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay
+
+    def reset(self):
+        self.delay = self.start
+
+
+class ConnectionSupervisor(QObject):
+    # watches a robot's video thread and control link from the GUI thread
+    # program is a robots.RobotLink, it provides th, initializeVideo(),
+    # initializeControl() -> bool, closeControl() and controlAlive()
+    stateChanged = pyqtSignal(str)
+    # no frame for this long means the stream has stalled
+    stall_timeout = 3.0
+    # a new stream gets this long to deliver its first frame
+    connect_timeout = 8.0
+    check_interval = 250
+    # a stopped video thread should be done after this long
+    stop_timeout = 6.0
+
+    def __init__(self, program):
+        super(ConnectionSupervisor, self).__init__(program)
+        self.program = program
+        self.video_backoff = Backoff()
+        self.ctrl_backoff = Backoff()
+        self.video_retry = None
+        self.ctrl_retry = None
+        self.state = None
+        # stopped video threads still winding down, kept until they finish
+        self.retired = []
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.check)
+
+    def start(self):
+        self.restartVideo()
+        self.restartControl()
+        self.timer.start(self.check_interval)
+        self.check()
+
+    def restart(self):
+        # manual reconnect, try both links right away
+        self.video_backoff.reset()
+        self.ctrl_backoff.reset()
+        self.restartVideo()
+        self.restartControl()
+        self.check()
+
+    def stopVideo(self):
+        # never waits, the old thread finishes on its own while the new
+        # one starts, its frames no longer reach the robot
+        th = self.program.th
+        if th is None:
+            return
+        th.stop()
+        try:
+            th.changePixmap.disconnect()
+            th.videoReady.disconnect()
+        except TypeError:
+            pass
+        if not th.isFinished():
+            self.retired.append((th, time.monotonic() + self.stop_timeout))
+
+    def reapVideo(self, now):
+        # (thread, deadline), the deadline is None once it has been reported
+        retired = []
+        for th, deadline in self.retired:
+            if th.isFinished():
+                continue
+            if deadline is not None and now > deadline:
+                log.warning("Video thread did not stop in %.1fs", self.stop_timeout)
+                deadline = None
+            retired.append((th, deadline))
+        self.retired = retired
+
+    def restartVideo(self):
+        self.video_retry = None
+        self.stopVideo()
+        self.program.initializeVideo()
+
+    def restartControl(self):
+        self.ctrl_retry = None
+        self.program.closeControl()
+        if self.program.initializeControl():
+            self.ctrl_backoff.reset()
+
+    def videoAlive(self):
+        th = self.program.th
+        if th is None or th.isFinished():
+            return False
+        # a thread that is still connecting counts from when it started
+        now = time.monotonic()
+        if not th.frames_seen:
+            return now - th.last_frame_t < self.connect_timeout
+        # frames still captured but none reaching the display means a
+        # later stage died or hung, restart the whole pipeline
+        return (now - th.last_frame_t < self.stall_timeout
+                and now - th.last_output_t < self.stall_timeout)
+
+    def check(self):
+        now = time.monotonic()
+        self.reapVideo(now)
+        video_ok = self.videoAlive()
+        ctrl_ok = self.program.controlAlive()
+
+        if video_ok:
+            if self.program.th.frames_seen:
+                self.video_backoff.reset()
+        elif self.video_retry is None:
+            delay = self.video_backoff.next()
+            log.warning("Video lost, reconnecting in %.1fs", delay)
+            self.video_retry = now + delay
+        elif now >= self.video_retry:
+            self.restartVideo()
+
+        if not ctrl_ok:
+            if self.ctrl_retry is None:
+                delay = self.ctrl_backoff.next()
+                log.warning("Control link lost, reconnecting in %.1fs", delay)
+                self.ctrl_retry = now + delay
+            elif now >= self.ctrl_retry:
+                self.restartControl()
+
+        self.setState(video_ok, ctrl_ok, now)
+
+    def setState(self, video_ok, ctrl_ok, now):
+        if video_ok and ctrl_ok:
+            state = 'Status: Connected'
+        elif not video_ok and not ctrl_ok:
+            state = 'Status: Disconnected'
+        else:
+            state = 'Status: %s down' % ('Control' if video_ok else 'Video')
+        retry = [t for t in (self.video_retry, self.ctrl_retry) if t is not None]
+        if retry:
+            state += ', retry in %ds' % max(0, int(round(min(retry) - now)))
+        if state != self.state:
+            self.state = state
+            self.stateChanged.emit(state)
+
+    def shutdown(self):
+        self.timer.stop()
+        self.stopVideo()
+        # closing, now it is worth waiting for the threads to clean up
+        for th, deadline in self.retired:
+            if not th.wait(2000):
+                log.warning("Video thread did not stop in time")
+        self.retired = []
+        self.program.closeControl()
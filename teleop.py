@@ -0,0 +1,132 @@
+# teleop.py
+# Keyboard driving, the held keys decide one drive state and commands
+# are only sent when that state changes
+
+import logging, threading, time
+import metrics
+from robot_protocol import RobotProtocol
+
+log = logging.getLogger(__name__)
+
+FORWARD, BACKWARD, LEFT, RIGHT = 'forward', 'backward', 'left', 'right'
+
+
+class Teleop(object):
+    # resend the current drive frame this often while moving, 0 never
+    keepalive = 0.5
+    # stop the robot if the GUI has not called tick() for this long, 0 never
+    watchdog = 0.3
+    # inner wheel speed relative to the outer one when curving
+    turn_ratio = 0.4
+
+    def __init__(self, send, speed=RobotProtocol.SPEED_MAX):
+        # send(frame) must be safe to call from any thread
+        self.send = send
+        self.speed = speed
+        self.held = set()
+        # (drive frame, left speed, right speed) last sent
+        self.state = (RobotProtocol.STOP, speed, speed)
+        self.sent_t = 0.0
+        self.beat = time.monotonic()
+        self.stalled = False
+        self.commands = 0
+        self.lock = threading.RLock()
+        self.running = True
+        if self.watchdog > 0:
+            threading.Thread(target=self.watch, name='teleop-watchdog', daemon=True).start()
+
+    def target(self):
+        # opposite keys cancel each other
+        move = (FORWARD in self.held) - (BACKWARD in self.held)
+        turn = (RIGHT in self.held) - (LEFT in self.held)
+        full = self.speed
+        if move == 0:
+            if turn == 0:
+                return (RobotProtocol.STOP, full, full)
+            return (RobotProtocol.RIGHT if turn > 0 else RobotProtocol.LEFT, full, full)
+        drive = RobotProtocol.FORWARD if move > 0 else RobotProtocol.BACKWARD
+        # W+A and friends curve by slowing the inner wheel
+        inner = int(round(full * self.turn_ratio))
+        if turn > 0:
+            return (drive, full, inner)
+        if turn < 0:
+            return (drive, inner, full)
+        return (drive, full, full)
+
+    def emit(self, frame):
+        self.send(frame)
+        self.commands += 1
+        metrics.gauge('teleop_commands', self.commands)
+
+    def apply(self, state, force=False):
+        # sends only the parts of the state that changed
+        drive, left, right = state
+        old_drive, old_left, old_right = self.state
+        if force or left != old_left:
+            self.emit(RobotProtocol.speed(left)[0])
+        if force or right != old_right:
+            self.emit(RobotProtocol.speed(right)[1])
+        if force or drive != old_drive:
+            self.emit(drive)
+        self.state = state
+        self.sent_t = time.monotonic()
+
+    def update(self):
+        with self.lock:
+            state = self.target()
+            if state != self.state:
+                self.apply(state)
+
+    def press(self, key):
+        with self.lock:
+            self.held.add(key)
+            self.update()
+
+    def release(self, key):
+        with self.lock:
+            self.held.discard(key)
+            self.update()
+
+    def set_speed(self, speed):
+        with self.lock:
+            self.speed = speed
+            self.update()
+
+    def clear(self):
+        # STOP override, always sent even if already stopped
+        with self.lock:
+            self.held.clear()
+            self.emit(RobotProtocol.STOP)
+            self.state = (RobotProtocol.STOP, self.state[1], self.state[2])
+            self.update()
+
+    def moving(self):
+        return self.state[0] != RobotProtocol.STOP
+
+    def tick(self):
+        # called regularly from the GUI thread, proves it is alive
+        now = time.monotonic()
+        with self.lock:
+            self.beat = now
+            if self.stalled:
+                # the GUI is back, but key releases from the stall may not
+                # have been handled yet, wait for a fresh key press
+                log.info("GUI responsive again, press a key to drive")
+                self.stalled = False
+                self.held.clear()
+            elif self.keepalive and self.moving() and now - self.sent_t >= self.keepalive:
+                self.emit(self.state[0])
+                self.sent_t = now
+
+    def watch(self):
+        while self.running:
+            time.sleep(self.watchdog / 2)
+            with self.lock:
+                if self.moving() and not self.stalled and time.monotonic() - self.beat > self.watchdog:
+                    log.warning("GUI stalled for %.2fs, stopping", time.monotonic() - self.beat)
+                    self.stalled = True
+                    self.emit(RobotProtocol.STOP)
+                    self.state = (RobotProtocol.STOP, self.state[1], self.state[2])
+
+    def close(self):
+        self.running = False
@@ -0,0 +1,125 @@
+# transport.py
+# Sends control frames to the robot from a background thread
+
+import threading, time, collections, logging
+import metrics
+
+from robot_protocol import RobotProtocol
+
+log = logging.getLogger(__name__)
+
+STOP = RobotProtocol.STOP
+# servo and motor channels, only the newest value of each is sent
+COALESCE = (
+    RobotProtocol.HORZ_TABLE[0][:3],
+    RobotProtocol.VERT_TABLE[0][:3],
+    RobotProtocol.SPEED_TABLE[0][0][:3],
+    RobotProtocol.SPEED_TABLE[0][1][:3],
+)
+DRIVE = RobotProtocol.STOP[:2]
+
+class CommandSender(threading.Thread):
+    # outgoing queue for the control socket, send() never blocks
+    # STOP jumps the queue, everything else goes out in the order it was
+    # sent, a servo or speed frame replaces the pending one of its channel
+    # unless another command was queued after it
+    send_timeout = 1.0
+
+    def __init__(self, sock, robot=None):
+        super(CommandSender, self).__init__(name='ctrl-sender', daemon=True)
+        self.sock = sock
+        # metrics label
+        self.robot = robot
+        self.sock.settimeout(self.send_timeout)
+        self.cond = threading.Condition()
+        self.urgent = collections.deque()
+        # [enqueue time, frame], items are updated in place when coalesced
+        self.queue = collections.deque()
+        # channel -> its pending item, while it is still the newest in the queue
+        self.latest = {}
+        self.running = True
+        self.sent = 0
+        self.coalesced = 0
+        self.error = None
+
+    def send(self, frame):
+        t = time.monotonic()
+        with self.cond:
+            if frame == STOP:
+                # drive commands queued before the stop are stale
+                self.queue = collections.deque(item for item in self.queue if item[1][:2] != DRIVE)
+                self.urgent.append((t, frame))
+            elif frame[:3] in COALESCE and frame[:3] in self.latest:
+                item = self.latest[frame[:3]]
+                item[0], item[1] = t, frame
+                self.coalesced += 1
+            else:
+                item = [t, frame]
+                self.queue.append(item)
+                if frame[:3] in COALESCE:
+                    self.latest[frame[:3]] = item
+                else:
+                    # a later value must not overtake this command
+                    self.latest.clear()
+            depth = len(self.urgent) + len(self.queue)
+            self.cond.notify()
+        metrics.gauge('ctrl_queue_depth', depth, self.robot)
+
+    def depth(self):
+        with self.cond:
+            return len(self.urgent) + len(self.queue)
+
+    def next_frame(self):
+        # (enqueue time, frame) or None
+        if self.urgent:
+            return self.urgent.popleft()
+        if self.queue:
+            item = self.queue.popleft()
+            if self.latest.get(item[1][:3]) is item:
+                del self.latest[item[1][:3]]
+            return item[0], item[1]
+        return None
+
+    def run(self):
+        while self.running:
+            with self.cond:
+                item = self.next_frame()
+                if item is None:
+                    self.cond.wait(0.1)
+                    continue
+            t, frame = item
+            try:
+                self.sock.sendall(frame)
+                self.sent += 1
+            except OSError as e:
+                log.error("Control send failed: %s", e)
+                self.error = e
+                self.running = False
+                continue
+            # time from run_cmd to the frame being on the wire
+            metrics.observe('ctrl_send', time.monotonic() - t, self.robot)
+            metrics.gauge('ctrl_queue_depth', self.depth(), self.robot)
+        if self.error is None:
+            self.flush_urgent()
+
+    def flush_urgent(self):
+        # a STOP queued just before closing must still reach the robot
+        with self.cond:
+            items = list(self.urgent)
+            self.urgent.clear()
+        for t, frame in items:
+            try:
+                self.sock.sendall(frame)
+                self.sent += 1
+            except OSError as e:
+                log.error("Control send failed: %s", e)
+                self.error = e
+                return
+
+    def close(self):
+        # returns once pending STOPs are sent, the socket can then be closed
+        self.running = False
+        with self.cond:
+            self.cond.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(self.send_timeout)
@@ -0,0 +1,136 @@
+# vision_client.py
+# Stands in for the video thread when the vision engine runs in a
+# vision_server process, the GUI only shows frames and sends settings
+
+import json, logging, socket, threading, time
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+import metrics
+import vision_protocol as vp
+
+log = logging.getLogger(__name__)
+
+
+class RemoteVThread(QThread):
+    changePixmap = pyqtSignal(QImage)
+    videoReady = pyqtSignal(bool, name='vidReady')
+    pipelineStats = pyqtSignal(dict)
+    markerEvent = pyqtSignal(str, int)
+    connect_timeout = 5.0
+    # Settings, changes are forwarded to the server
+    do_face_recog = False
+    do_aruco = False
+    save_face = False
+    should_record_video = False
+    should_save_screenshot1 = False
+    should_save_screenshot2 = False
+    display_size = (640, 480)
+    display_enabled = True
+    # metrics label, set by the robot link
+    robot_name = None
+
+    def __init__(self, address, parent=None):
+        super(RemoteVThread, self).__init__(parent)
+        self.address = address
+        self.sock = None
+        self.lock = threading.Lock()
+        self.running = False
+        # watched by the connection supervisor
+        self.last_frame_t = time.monotonic()
+        self.last_output_t = self.last_frame_t
+        self.frames_seen = 0
+        # marker poses from the server, for the marker follower
+        self.marker_tracker = None
+        self.pose_times = {}
+        # sessionlog.SessionLog for marker events, set by the robot link
+        self.session_log = None
+
+    def __setattr__(self, name, value):
+        super(RemoteVThread, self).__setattr__(name, value)
+        if name in vp.SETTINGS:
+            self.send(vp.pack_json(vp.SET, {name: value}))
+
+    def send(self, data):
+        # called from the GUI thread, nothing is sent before the connection is up
+        sock = getattr(self, 'sock', None)
+        if sock is None:
+            return
+        try:
+            with self.lock:
+                sock.sendall(data)
+        except OSError as e:
+            log.warning("Vision server send failed: %s", e)
+
+    def frame_shown(self):
+        self.send(vp.pack(vp.SHOWN))
+
+    def stop(self):
+        self.running = False
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def update_poses(self, poses, now):
+        if self.marker_tracker is None:
+            import markers
+            self.marker_tracker = markers.MarkerTracker()
+        ids, rvecs, tvecs = [], [], []
+        for marker_id, t_server, age, rvec, tvec in poses:
+            if self.pose_times.get(marker_id) == t_server:
+                continue
+            self.pose_times[marker_id] = t_server
+            ids.append(marker_id)
+            rvecs.append(rvec)
+            tvecs.append(tvec)
+        # the oldest new pose dates the batch, they come from one frame
+        ages = [p[2] for p in poses if p[0] in ids]
+        self.marker_tracker.update(ids, rvecs, tvecs, now - max(ages) if ages else now)
+
+    def handle(self, kind, payload):
+        if kind == vp.FRAME:
+            header, jpeg = vp.unpack_frame(payload)
+            now = time.monotonic()
+            # the server's pipeline is only seen through its output
+            self.last_frame_t = self.last_output_t = now
+            self.frames_seen += 1
+            if header.get('poses') is not None:
+                self.update_poses(header['poses'], now)
+            img = QImage.fromData(jpeg, 'JPG')
+            metrics.observe('remote_frame_age', header['age'], self.robot_name)
+            self.changePixmap.emit(img)
+        elif kind == vp.READY:
+            self.videoReady.emit(json.loads(payload.decode())['ok'])
+        elif kind == vp.EVENT:
+            event = json.loads(payload.decode())
+            if self.session_log is not None:
+                self.session_log.marker(event['event'], event['id'])
+            self.markerEvent.emit(event['event'], event['id'])
+        elif kind == vp.STATS:
+            self.pipelineStats.emit(json.loads(payload.decode()))
+
+    def run(self):
+        self.running = True
+        self.last_frame_t = time.monotonic()
+        try:
+            sock = socket.create_connection(self.address, self.connect_timeout)
+        except OSError as e:
+            log.error("Could not connect to vision server %s:%d: %s", self.address[0], self.address[1], e)
+            self.videoReady.emit(False)
+            return
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        # bring the server in line with our modes
+        self.send(vp.pack_json(vp.SET, dict((name, getattr(self, name)) for name in vp.SETTINGS)))
+        try:
+            while self.running:
+                kind, payload = vp.recv(sock)
+                self.handle(kind, payload)
+        except (OSError, ValueError) as e:
+            if self.running:
+                log.warning("Vision server connection lost: %s", e)
+        self.sock = None
+        sock.close()
@@ -0,0 +1,59 @@
+# vision_protocol.py
+# Messages between the headless vision server and its GUI clients
+# every message is <kind:1> <length:4, big endian> <payload>
+
+import json, struct
+
+# server -> client
+READY = b'R'    # json {"ok": bool}
+FRAME = b'F'    # <header length:4> json header, then the annotated JPEG
+EVENT = b'E'    # json {"event": appear | return | disappear, "id": marker id}
+STATS = b'S'    # json pipeline stats
+# client -> server
+SET = b'C'      # json {setting: value}
+SHOWN = b'A'    # the last frame was painted, send the next one
+
+# engine settings a client may change
+SETTINGS = (
+    'do_face_recog', 'do_aruco', 'save_face', 'should_record_video',
+    'should_save_screenshot1', 'should_save_screenshot2',
+    'display_size', 'display_enabled',
+)
+
+_head = struct.Struct('>cI')
+_len = struct.Struct('>I')
+
+
+def pack(kind, payload=b''):
+    return _head.pack(kind, len(payload)) + payload
+
+
+def pack_json(kind, obj):
+    return pack(kind, json.dumps(obj).encode())
+
+
+def pack_frame(header, jpeg):
+    head = json.dumps(header).encode()
+    return pack(FRAME, _len.pack(len(head)) + head + jpeg)
+
+
+def unpack_frame(payload):
+    # returns (header, jpeg bytes)
+    n, = _len.unpack_from(payload)
+    return json.loads(payload[4:4 + n].decode()), payload[4 + n:]
+
+
+def recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        buf += chunk
+    return bytes(buf)
+
+
+def recv(sock):
+    # blocks for the next message, returns (kind, payload)
+    kind, n = _head.unpack(recv_exact(sock, _head.size))
+    return kind, recv_exact(sock, n)
@@ -0,0 +1,242 @@
+# vision_server.py
+# Runs the vision engine without a GUI and streams annotated frames and
+# detection events to clients over a local socket
+#     python3 vision_server.py --stream URL --listen 127.0.0.1:8090
+
+import argparse, json, logging, select, socket, threading, time
+import cv2
+import engine
+import recorder
+import sessionlog
+import vision_protocol as vp
+
+log = logging.getLogger(__name__)
+
+
+class Client(object):
+    # one connected GUI, at most one frame is in flight to it
+    send_timeout = 1.0
+
+    def __init__(self, server, conn, address):
+        self.server = server
+        self.conn = conn
+        self.address = address
+        self.conn.settimeout(self.send_timeout)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.alive = True
+        self.reader = threading.Thread(target=self.read_loop, name='vision-client', daemon=True)
+
+    def send(self, data):
+        if not self.alive:
+            return False
+        try:
+            with self.lock:
+                self.conn.sendall(data)
+            return True
+        except OSError as e:
+            log.info("Client %s gone: %s", self.address, e)
+            self.close()
+            return False
+
+    def read_loop(self):
+        # the socket keeps its send timeout, so wait for a message to start
+        # before reading it, a message that stalls halfway drops the client
+        try:
+            while self.alive:
+                select.select([self.conn], [], [])
+                if not self.alive:
+                    break
+                kind, payload = vp.recv(self.conn)
+                if kind == vp.SHOWN:
+                    self.pending = 0
+                elif kind == vp.SET:
+                    self.server.apply(json.loads(payload.decode()))
+        except (OSError, ValueError) as e:
+            if self.alive:
+                log.info("Client %s disconnected: %s", self.address, e)
+        self.close()
+
+    def close(self):
+        if self.alive:
+            self.alive = False
+            self.server.remove(self)
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.conn.close()
+
+
+class EngineServer(engine.VisionEngine):
+    jpeg_quality = 80
+    # a client that has not acknowledged a frame for this long gets the next one
+    display_timeout = 0.5
+
+    def __init__(self, address=('127.0.0.1', 8090)):
+        engine.VisionEngine.__init__(self)
+        self.address = address
+        self.clients = []
+        self.lock = threading.Lock()
+        self.is_ready = None
+        self.sock = None
+
+    def listen(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(4)
+        threading.Thread(target=self.accept_loop, name='vision-accept', daemon=True).start()
+        log.info("Vision server listening on %s:%d", *self.address)
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = Client(self, conn, address)
+            log.info("Client connected from %s", address)
+            with self.lock:
+                self.clients.append(client)
+            if self.is_ready is not None:
+                client.send(vp.pack_json(vp.READY, {'ok': self.is_ready}))
+            client.reader.start()
+
+    def remove(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def apply(self, settings):
+        for name, value in settings.items():
+            if name not in vp.SETTINGS:
+                log.warning("Ignoring unknown setting %s", name)
+                continue
+            if name == 'display_size':
+                value = tuple(value)
+            setattr(self, name, value)
+
+    def broadcast(self, data):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.send(data)
+
+    def ready(self, ok):
+        self.is_ready = ok
+        self.broadcast(vp.pack_json(vp.READY, {'ok': ok}))
+
+    def publish_stats(self, stats):
+        self.broadcast(vp.pack_json(vp.STATS, stats))
+
+    def publish_marker(self, event, marker_id):
+        self.broadcast(vp.pack_json(vp.EVENT, {'event': event, 'id': marker_id}))
+
+    def show_frame(self, pkt):
+        now = time.monotonic()
+        with self.lock:
+            clients = [c for c in self.clients
+                       if not c.pending or now - c.pending >= self.display_timeout]
+        if not clients:
+            return False
+        # encode once for every client that is ready for a frame
+        rgb = pkt.rgb
+        h, w = rgb.shape[:2]
+        dw, dh = self.display_size
+        scale = min(dw / w, dh / h)
+        if scale < 1.0:
+            rgb = cv2.resize(rgb, (max(int(w * scale), 1), max(int(h * scale), 1)),
+                             interpolation=cv2.INTER_AREA)
+        ok, buf = cv2.imencode('.jpg', cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR),
+                               [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not ok:
+            return False
+        data = vp.pack_frame(self.frame_header(pkt, now), buf.tobytes())
+        sent = False
+        for client in clients:
+            client.pending = now
+            sent = client.send(data) or sent
+        return sent
+
+    def frame_header(self, pkt, now):
+        header = {
+            'seq': pkt.seq,
+            'age': now - pkt.t_capture,
+            'faces': [[list(loc), name] for loc, name in pkt.faces],
+        }
+        if self.marker_tracker is not None:
+            # server time of each pose lets clients skip poses they have seen
+            header['poses'] = [[i, t, now - t, list(map(float, rvec)), list(map(float, tvec))]
+                               for i, (t, rvec, tvec) in self.marker_tracker.latest_poses().items()]
+        return header
+
+    def close(self):
+        self.stop()
+        if self.sock is not None:
+            self.sock.close()
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+
+
+def parse_address(text):
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless vision engine')
+    parser.add_argument('--stream', default=engine.VisionEngine.stream_url, help='video stream url')
+    parser.add_argument('--listen', type=parse_address, default=('127.0.0.1', 8090), help='host:port to serve on')
+    parser.add_argument('--calib', default=engine.VisionEngine.calib_file, help='camera calibration file')
+    parser.add_argument('--face', action='store_true', help='start with face recognition on')
+    parser.add_argument('--aruco', action='store_true', help='start with AR mode on')
+    parser.add_argument('--record-codec', choices=sorted(recorder.Recorder.CODECS), default='mjpg',
+                        help='video codec, mjpg and xvid record to .avi, mp4v and h264 to .mp4')
+    parser.add_argument('--preroll', type=float, default=engine.VisionEngine.preroll_seconds,
+                        help='seconds of video kept from before recording starts, 0 for none')
+    parser.add_argument('--stream-control-url', metavar='URL', default=None,
+                        help='url asking the camera for a lower mode under load, '
+                             'with {width}, {height} and {fps}')
+    parser.add_argument('--frame-bus', action='store_true',
+                        help='run face detection and ArUco in parallel processes over shared memory')
+    parser.add_argument('--session-log', default=None, help='log marker events and face matches to this file')
+    parser.add_argument('--metrics-jsonl', metavar='FILE', default=None,
+                        help='append pipeline metrics to FILE as JSON lines every second')
+    parser.add_argument('--metrics-prom', metavar='FILE', default=None,
+                        help='write pipeline metrics to FILE in Prometheus text format every second')
+    parser.add_argument('--debug', action='store_true', help='verbose logging')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    server = EngineServer(args.listen)
+    server.stream_url = args.stream
+    server.calib_file = args.calib
+    server.do_face_recog = args.face
+    server.do_aruco = args.aruco
+    server.use_frame_bus = args.frame_bus
+    server.stream_control_url = args.stream_control_url
+    server.record_codec = args.record_codec
+    server.preroll_seconds = args.preroll
+    server.metrics_jsonl = args.metrics_jsonl
+    server.metrics_prom = args.metrics_prom
+    if args.session_log:
+        server.session_log = sessionlog.SessionLog(args.session_log)
+    server.listen()
+    try:
+        # the engine returns when the stream is lost, open it again
+        while True:
+            server.run()
+            time.sleep(2.0)
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    if server.session_log is not None:
+        server.session_log.close()
+
+
+if __name__ == '__main__':
+    main()